@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import collections
+import click
+import cv2
+import multiprocessing
+from processors import FrameTagger
+from qr_extractor import extract
+from qr_decoder import QrDecoder
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.mpg', '.mpeg', '.h264', '.webm')
+
+tagger = None
+qrcodes = False
+decoder = None
+
+def init_worker(tagging, extract_qrcodes, decode):
+    # one FrameTagger per worker process, frames are spread across workers so no tracking
+    global tagger, qrcodes, decoder
+    FrameTagger.timer_logger = None
+    tagger = FrameTagger(tagging, decode_qrcodes=decode)
+    qrcodes = extract_qrcodes
+    decoder = QrDecoder() if decode else None
+
+def tag_job(job):
+    source, index, position, frame = job
+    record = dict(source=source, frame=index)
+    if position is not None:
+        record['position'] = position
+    if index < 0:
+        record['error'] = 'could not open video'
+        return record
+    if frame is None:
+        frame = cv2.imread(source)
+        if frame is None:
+            record['error'] = 'could not read image'
+            return record
+    record['shape'] = list(frame.shape)
+    record['tags'] = tagger.detect_frame_tags(frame)
+    if tagger.qr_decoder:
+        record['payloads'] = tagger.payloads
+    if qrcodes:
+        codes, _, rects = extract(frame, locate=True)
+        # module grids as rows of 0/1, 1 for a dark module
+        record['qrcodes'] = [dict(polygon=rect, modules=[''.join('1' if v < 128 else '0' for v in row) for row in code])
+                             for code, rect in zip(codes, rects)]
+        if decoder:
+            for code, payload in zip(record['qrcodes'], decoder.decode(frame, rects)):
+                code['payload'] = payload
+    return record
+
+def list_sources(paths):
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                sources += [os.path.join(root, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXTENSIONS + VIDEO_EXTENSIONS)]
+        else:
+            sources.append(path)
+    return sources
+
+def resume_point(output):
+    # the output is written in order, so its last complete record is where to pick up;
+    # a line cut short by an interruption is dropped
+    if not os.path.exists(output):
+        return None
+    last, good = None, 0
+    with open(output, 'rb+') as f:
+        for line in f:
+            try:
+                last = json.loads(line)
+                good += len(line)
+            except ValueError:
+                break
+        f.truncate(good)
+    return last
+
+def generate_jobs(sources, every, resume):
+    # frames are decoded here one at a time, the pool window bounds how many are in flight
+    skipping = resume is not None
+    for source in sources:
+        if skipping:
+            if source != resume['source']:
+                continue
+            skipping = False
+            if 'error' in resume or not source.lower().endswith(VIDEO_EXTENSIONS):
+                continue
+        if not source.lower().endswith(VIDEO_EXTENSIONS):
+            yield source, 0, None, None
+            continue
+        start = resume['frame'] + 1 if resume and source == resume['source'] else 0
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            yield source, -1, None, None
+            continue
+        index = 0
+        while True:
+            if index < start or index % every:
+                if not capture.grab():
+                    break
+            else:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield source, index, capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0, frame
+            index += 1
+        capture.release()
+
+@click.command()
+@click.argument('paths', nargs=-1, required=True)
+@click.option('--output', default='tags.jsonl', help='JSONL file receiving one record per frame, in input order')
+@click.option('--tagging', default='qrcode,plate,face', help='available taggings: qrcode,plate,face')
+@click.option('--qrcodes/--no-qrcodes', default=True, help='also extract the qr code module grids')
+@click.option('--decode/--no-decode', default=True, help='decode the qr code payloads')
+@click.option('--every', default=1, help='tag every Nth frame of videos')
+@click.option('--workers', default=os.cpu_count(), help='tagging processes')
+@click.option('--resume/--restart', default=True, help='continue after the last record already in the output')
+def run_batch(paths, output, tagging, qrcodes, decode, every, workers, resume):
+    sources = list_sources(paths)
+    last = resume_point(output) if resume else None
+    if last and last['source'] not in sources:
+        raise click.UsageError(f'{output} was written for other inputs, use --restart or another --output')
+    if last:
+        print(f'resuming after {last["source"]} frame {last["frame"]}')
+    spawn = multiprocessing.get_context('spawn')
+    pool = spawn.Pool(workers, initializer=init_worker, initargs=(tagging, qrcodes, decode))
+    # results are written in submission order, the window keeps every worker busy
+    # while holding at most a few decoded frames per worker
+    pending = collections.deque()
+    written = 0
+    started = last_report = time.perf_counter()
+    with open(output, 'a' if resume else 'w') as out:
+
+        def write(result):
+            nonlocal written, last_report
+            out.write(json.dumps(result.get()) + '\n')
+            out.flush()
+            written += 1
+            if time.perf_counter() - last_report >= 10.0:
+                last_report = time.perf_counter()
+                print(f'{written} frames tagged, {written / (last_report - started):.1f} fps')
+
+        for source, index, position, frame in generate_jobs(sources, every, last):
+            pending.append(pool.apply_async(tag_job, ((source, index, position, frame),)))
+            while len(pending) >= 2 * workers:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+    pool.close()
+    pool.join()
+    print(f'{written} frames tagged in {time.perf_counter() - started:.1f}s')
+
+if __name__ == '__main__':
+    run_batch()
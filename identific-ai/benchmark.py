@@ -0,0 +1,184 @@
+import os
+import sys
+import gc
+import json
+import time
+import socket
+import platform
+import datetime
+import resource
+import tracemalloc
+import click
+import cv2
+import numpy as np
+from utils import compile_transform, apply_transform
+from processors import FrameTagger
+from qr_extractor import extract
+
+TESTIMAGES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'assets', 'testimages')
+RESOLUTIONS = {
+    '480p': (854, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+}
+DEFAULT_TRANSFORM = json.dumps([
+    {'transformation': 'Rotate', 'degrees': 3},
+    {'transformation': 'Crop', 'xPosition': 0, 'yPosition': 0, 'width': 100000, 'height': 100000},
+    {'transformation': 'Resize', 'width': 1280, 'height': None},
+])
+
+
+def load_images(names=None):
+    images = {}
+    for name in sorted(os.listdir(TESTIMAGES)):
+        if names and name not in names:
+            continue
+        image = cv2.imread(os.path.join(TESTIMAGES, name))
+        if image is not None:
+            images[name] = image
+    return images
+
+def synthetic_video(image, size, frames):
+    # a slow pan and zoom over the image, so consecutive frames differ like a real camera feed
+    w, h = size
+    base = cv2.resize(image, (int(w * 1.25), int(h * 1.25)), interpolation=cv2.INTER_AREA)
+    max_x, max_y = base.shape[1] - w, base.shape[0] - h
+    video = []
+    for i in range(frames):
+        t = i / float(max(1, frames - 1))
+        x, y = int(max_x * t), int(max_y * (0.5 - 0.5 * np.cos(np.pi * t)))
+        video.append(np.ascontiguousarray(base[y:y+h, x:x+w]))
+    return video
+
+def measure(fn, frames, repeat, warmup=1):
+    for frame in frames[:warmup]:
+        fn(frame)
+    timings = []
+    for _ in range(repeat):
+        for frame in frames:
+            start = time.perf_counter()
+            fn(frame)
+            timings.append(time.perf_counter() - start)
+
+    # a separate, traced pass: tracemalloc slows allocations down and would skew the timings
+    gc.collect()
+    tracemalloc.start()
+    for frame in frames:
+        fn(frame)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize(timings, peak)
+
+def summarize(timings, peak):
+    ms = np.array(timings) * 1000.0
+    return {
+        'frames': len(ms),
+        'mean_ms': round(float(ms.mean()), 3),
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(ms, 95)), 3),
+        'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        'fps': round(1000.0 / float(ms.mean()), 2) if ms.mean() > 0 else None,
+        'peak_alloc_mb': round(peak / 1048576.0, 3),
+    }
+
+def build_cases(detectors, transform):
+    pipeline = compile_transform(transform)
+    cases = {'transform': lambda frame: apply_transform(frame, pipeline)}
+    for name in detectors:
+        tagger = FrameTagger(name)
+        cases[f'detect-{name}'] = tagger.detect_frame_tags
+    if len(detectors) > 1:
+        cases['detect-all'] = FrameTagger(','.join(detectors)).detect_frame_tags
+        cases['detect-all-parallel'] = FrameTagger(','.join(detectors), parallel=True).detect_frame_tags
+    cases['qr-extract'] = extract
+    return cases
+
+def video_cases(detectors, detect_every):
+    # stateful taggers only make sense on a frame sequence, build them fresh per video
+    tagging = ','.join(detectors)
+    return {
+        f'detect-all-every-{detect_every}': FrameTagger(tagging, detect_every=detect_every).detect_frame_tags,
+    }
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get('results', {}).get(key)
+        if not before or not before.get('p50_ms'):
+            continue
+        ratio = result['p50_ms'] / before['p50_ms']
+        result['baseline_p50_ms'] = before['p50_ms']
+        result['p50_ratio'] = round(ratio, 3)
+        if ratio > 1.0 + tolerance:
+            regressions.append((key, before['p50_ms'], result['p50_ms'], ratio))
+    return regressions
+
+
+@click.command()
+@click.option('--resolutions', default='480p,720p,1080p', help=f'comma separated, among {",".join(RESOLUTIONS)}')
+@click.option('--images', default='', help='comma separated test image names, all of assets/testimages by default')
+@click.option('--tagging', default='qrcode,plate,face', help='detectors to benchmark')
+@click.option('--transform', default=DEFAULT_TRANSFORM, help='transform spec to benchmark, as for input-streamer')
+@click.option('--video-frames', default=30, help='frames per synthetic video, 0 to skip videos')
+@click.option('--detect-every', default=5, help='detection cadence for the tracked video case')
+@click.option('--repeat', default=3, help='passes over the frames of each case')
+@click.option('--output', default=None, help='write the json report here instead of stdout')
+@click.option('--baseline', default=None, help='json report to compare against')
+@click.option('--tolerance', default=0.10, help='allowed p50 slowdown against the baseline')
+def run_benchmark(resolutions, images, tagging, transform, video_frames, detect_every, repeat, output, baseline, tolerance):
+    FrameTagger.timer_logger = None
+    detectors = [d for d in tagging.split(',') if d]
+    sources = load_images([n for n in images.split(',') if n])
+    if not sources:
+        raise click.UsageError(f'no test images found in {TESTIMAGES}')
+
+    results = {}
+    for resolution in resolutions.split(','):
+        size = RESOLUTIONS[resolution]
+        frames = [cv2.resize(image, size, interpolation=cv2.INTER_AREA) for image in sources.values()]
+        for case, fn in build_cases(detectors, transform).items():
+            key = f'{case}/{resolution}/images'
+            results[key] = measure(fn, frames, repeat)
+            print(key, results[key]['p50_ms'], 'ms', file=sys.stderr)
+
+        if video_frames:
+            video = [f for image in sources.values() for f in synthetic_video(image, size, video_frames)]
+            cases = build_cases(detectors, transform)
+            if detectors:
+                cases.update(video_cases(detectors, detect_every))
+            for case, fn in cases.items():
+                key = f'{case}/{resolution}/video'
+                results[key] = measure(fn, video, 1, warmup=0)
+                print(key, results[key]['p50_ms'], 'ms', file=sys.stderr)
+
+    report = {
+        'meta': {
+            'hostname': socket.gethostname(),
+            'datetime': datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'cpus': os.cpu_count(),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+        },
+        'results': results,
+    }
+
+    regressions = []
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        report['regressions'] = [key for key, *_ in regressions]
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    for key, before, after, ratio in regressions:
+        print(f'REGRESSION {key}: p50 {before:.1f} ms -> {after:.1f} ms ({ratio:.2f}x)', file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import queue
+import sqlite3
+import threading
+from werkzeug.wrappers import Response
+from frame_metadata import parse_timestamp
+from metrics import REGISTRY
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    host_id INTEGER NOT NULL,
+    tag_id INTEGER NOT NULL,
+    x INTEGER, y INTEGER, w INTEGER, h INTEGER,
+    crop TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_time ON detections (time);
+CREATE INDEX IF NOT EXISTS detections_host_time ON detections (host_id, time);
+CREATE INDEX IF NOT EXISTS detections_tag_time ON detections (tag_id, time);
+"""
+
+MAX_LIMIT = 10000
+
+
+class DetectionIndex():
+    """
+    SQLite index of every dumped tag crop. Detections are queued by add() and inserted
+    by a writer thread in batches, one transaction per batch; the database runs in WAL
+    mode so queries, from this or another process, never block the writer.
+    """
+
+    def __init__(self, path='tag_dump/detections.db', batch_size=1000, flush_every=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_every = flush_every
+        self.pending = queue.SimpleQueue()
+        self._ids = {}
+        self._stop = False
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.indexed = REGISTRY.counter('identific_detections_indexed_total', 'detections written to the index')
+
+    def start(self):
+        self._thread.start()
+        print('indexing detections in', self.path)
+        return self
+
+    def add(self, host, timestamp, tag, bbox, crop):
+        self.pending.put((timestamp, host, tag) + tuple(int(v) for v in bbox) + (crop,))
+
+    def _run(self):
+        db = connect(self.path)
+        db.executescript(SCHEMA)
+        while not self._stop or not self.pending.empty():
+            batch = []
+            deadline = time.perf_counter() + self.flush_every
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get(timeout=max(0.0, deadline - time.perf_counter())))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self.insert(db, batch)
+                except Exception as e:
+                    print('detection index failed on batch:', e)
+        db.close()
+
+    def insert(self, db, batch):
+        with db:
+            rows = [(timestamp, self.name_id(db, 'hosts', host), self.name_id(db, 'tags', tag)) + tuple(rest)
+                    for timestamp, host, tag, *rest in batch]
+            db.executemany('INSERT INTO detections (time, host_id, tag_id, x, y, w, h, crop) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.indexed.inc(len(rows))
+
+    def name_id(self, db, table, name):
+        key = (table, name)
+        if key not in self._ids:
+            db.execute(f'INSERT OR IGNORE INTO {table} (name) VALUES (?)', (name,))
+            self._ids[key] = db.execute(f'SELECT id FROM {table} WHERE name = ?', (name,)).fetchone()[0]
+        return self._ids[key]
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+
+def connect(path, readonly=False):
+    if readonly:
+        # shared by the serving threads, see read()
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+    else:
+        db = sqlite3.connect(path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+def read(path, sql, params=()):
+    # one shared read-only connection per database, used by one request at a time
+    with _readers_lock:
+        if path not in _readers:
+            _readers[path] = connect(path, readonly=True)
+        return _readers[path].execute(sql, params).fetchall()
+
+def filters(host=None, tag=None, start=None, end=None):
+    where, params = [], []
+    if host:
+        where.append('d.host_id = (SELECT id FROM hosts WHERE name = ?)')
+        params.append(host)
+    if tag:
+        where.append('d.tag_id = (SELECT id FROM tags WHERE name = ?)')
+        params.append(tag)
+    if start is not None:
+        where.append('d.time >= ?')
+        params.append(parse_timestamp(start))
+    if end is not None:
+        where.append('d.time < ?')
+        params.append(parse_timestamp(end))
+    return where, params
+
+def query_detections(path, host=None, tag=None, start=None, end=None, limit=1000, cursor=None):
+    # keyset pagination on (time, id): pass the returned cursor to get the next page
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError(f'limit must be a positive number, got {limit}')
+    limit = min(limit, MAX_LIMIT)
+    where, params = filters(host, tag, start, end)
+    if cursor:
+        cursor_time, cursor_id = cursor.split(',')
+        where.append('(d.time, d.id) > (?, ?)')
+        params += [float(cursor_time), int(cursor_id)]
+    sql = ('SELECT d.id, d.time, h.name, t.name, d.x, d.y, d.w, d.h, d.crop FROM detections d '
+           'JOIN hosts h ON h.id = d.host_id JOIN tags t ON t.id = d.tag_id')
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY d.time, d.id LIMIT ?'
+    rows = read(path, sql, params + [limit])
+    detections = [{'id': id, 'time': t, 'hostname': host, 'tag': tag, 'bbox': [x, y, w, h], 'crop': crop}
+                  for id, t, host, tag, x, y, w, h, crop in rows]
+    next_cursor = f'{rows[-1][1]!r},{rows[-1][0]}' if len(rows) == limit else None
+    return detections, next_cursor
+
+def summarize_detections(path, host=None, tag=None, start=None, end=None):
+    where, params = filters(host, tag, start, end)
+    sql = ('SELECT h.name, t.name, COUNT(*), MIN(d.time), MAX(d.time) FROM detections d '
+           'JOIN hosts h ON h.id = d.host_id JOIN tags t ON t.id = d.tag_id')
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' GROUP BY d.host_id, d.tag_id'
+    return [{'hostname': host, 'tag': tag, 'count': count, 'first': first, 'last': last}
+            for host, tag, count, first, last in read(path, sql, params)]
+
+def detections_response(request, path):
+    # GET /detections?host=&tag=&start=&end=&limit=&cursor= and /detections/summary?host=&tag=&start=&end=
+    args = {key: request.args.get(key) for key in ('host', 'tag', 'start', 'end')}
+    try:
+        if request.path.rstrip('/').endswith('/summary'):
+            body = {'summary': summarize_detections(path, **args)}
+        else:
+            detections, cursor = query_detections(path, limit=request.args.get('limit', 1000),
+                                                  cursor=request.args.get('cursor'), **args)
+            body = {'detections': detections, 'cursor': cursor}
+    except (ValueError, TypeError) as e:
+        return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+    except sqlite3.OperationalError as e:
+        return Response(json.dumps({'error': str(e)}), status=503, mimetype='application/json')
+    return Response(json.dumps(body), mimetype='application/json')
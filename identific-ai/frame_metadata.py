@@ -0,0 +1,104 @@
+import json
+import struct
+import datetime
+import numpy as np
+
+# binary frame metadata, little endian:
+#   header  magic, version, number of tag types, hostname length, sequence number,
+#           monotonic capture time (ns), wall clock capture time (s), extension length
+#   hostname (utf-8)
+#   per tag type: name length, name, tag count, points per tag, count * points * 2 int32
+#   extension: json object with any other metadata keys (tag_ids, ...)
+MAGIC = b'IDMD'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHQqdI')
+TAG_HEADER = struct.Struct('<B')
+TAG_COUNTS = struct.Struct('<IB')
+CORE_KEYS = ('hostname', 'seq', 'monotonic_ns', 'time', 'tags', 'datetime')
+
+
+def encode_metadata(metadata):
+    hostname = metadata.get('hostname', '').encode()
+    tags = metadata.get('tags') or {}
+    extension = {k: v for k, v in metadata.items() if k not in CORE_KEYS}
+    extension = json.dumps(extension, default=_json_default).encode() if extension else b''
+    parts = [HEADER.pack(MAGIC, VERSION, len(tags), len(hostname), metadata.get('seq', 0),
+                         metadata.get('monotonic_ns', 0), metadata.get('time', 0.0), len(extension)), hostname]
+    for name, found in tags.items():
+        # one conversion per tag type, the polygons must all have the same number of points
+        points = np.asarray(found, dtype='<i4')
+        if points.size == 0:
+            points = points.reshape(0, 0, 2)
+        if points.ndim != 3 or points.shape[2] != 2:
+            raise ValueError(f'{name} tags are not polygons of the same size')
+        encoded = name.encode()
+        parts += [TAG_HEADER.pack(len(encoded)), encoded, TAG_COUNTS.pack(points.shape[0], points.shape[1]), points.tobytes()]
+    parts.append(extension)
+    return b''.join(parts)
+
+def decode_metadata(buffer):
+    buffer = memoryview(buffer)
+    magic, version, ntags, host_len, seq, monotonic_ns, timestamp, ext_len = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'unsupported metadata {bytes(magic)!r} version {version}')
+    offset = HEADER.size
+    metadata = {
+        'hostname': bytes(buffer[offset:offset + host_len]).decode(),
+        'seq': seq,
+        'monotonic_ns': monotonic_ns,
+        'time': timestamp,
+    }
+    offset += host_len
+    tags = {}
+    for _ in range(ntags):
+        (name_len,) = TAG_HEADER.unpack_from(buffer, offset)
+        offset += TAG_HEADER.size
+        name = bytes(buffer[offset:offset + name_len]).decode()
+        offset += name_len
+        count, points = TAG_COUNTS.unpack_from(buffer, offset)
+        offset += TAG_COUNTS.size
+        tags[name] = np.frombuffer(buffer, dtype='<i4', count=count * points * 2, offset=offset).reshape(count, points, 2)
+        offset += count * points * 2 * 4
+    metadata['tags'] = tags
+    if ext_len:
+        metadata.update(json.loads(bytes(buffer[offset:offset + ext_len])))
+    return metadata
+
+def is_binary(msg):
+    return isinstance(msg, (bytes, bytearray, memoryview))
+
+def parse_metadata(msg):
+    # frames may carry either json or binary metadata while cameras are upgraded
+    if is_binary(msg):
+        return decode_metadata(msg)
+    return json.loads(msg)
+
+def metadata_datetime(metadata):
+    if 'datetime' in metadata:
+        return metadata['datetime']
+    return datetime.datetime.fromtimestamp(metadata['time']).strftime('%Y%m%d%H%M%S.%f')
+
+def metadata_time(metadata):
+    # capture time as epoch seconds, whichever of the two forms the sender used
+    if 'time' in metadata:
+        return metadata['time']
+    return datetime.datetime.strptime(metadata['datetime'], '%Y%m%d%H%M%S.%f').timestamp()
+
+def parse_timestamp(value):
+    # epoch seconds, or the YYYYmmddHHMMSS[.ffffff] form used in the frame metadata
+    try:
+        value = float(value)
+        if value < 1e13:
+            return value
+    except (TypeError, ValueError):
+        pass
+    value = str(value)
+    fmt = '%Y%m%d%H%M%S.%f' if '.' in value else '%Y%m%d%H%M%S'
+    return datetime.datetime.strptime(value, fmt).timestamp()
+
+def _json_default(obj):
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
@@ -0,0 +1,220 @@
+import time
+import collections
+import numpy as np
+from threading import Thread, Condition, Event, Lock
+from processors import VideoStreamSubscriber, request_keyframe
+from shm_transport import ShmVideoStreamSubscriber, is_shm_address, SCHEME
+from utils import retain
+from metrics import REGISTRY
+
+# a source that sent nothing for this long is reconnected
+RECEIVE_TIMEOUT = 15.0
+
+
+def parse_source(source):
+    # ip:port, or shm://name:port
+    address, port = source.rsplit(':', 1)
+    return address, int(port)
+
+def create_subscriber(src_ip, src_port, keyframe_port=0, policy='latest'):
+    if is_shm_address(src_ip):
+        receiver = ShmVideoStreamSubscriber(src_ip[len(SCHEME):], src_port, policy)
+    else:
+        receiver = VideoStreamSubscriber(src_ip, src_port, policy)
+    receiver.start()
+    if keyframe_port:
+        request_keyframe(source_host(src_ip), keyframe_port)
+    return receiver
+
+def source_host(src_ip):
+    return '127.0.0.1' if is_shm_address(src_ip) else src_ip
+
+class CameraRing():
+    """
+    Fixed size ring of the last frames of one camera. Raw frames are copied into slots
+    allocated once from the first frame's shape and dtype, so the ring owns its frames
+    whatever transport they came from; jpeg and roi frames are kept as small copies.
+    A slot is reused after `slots` newer frames of the same camera, consumers holding
+    a frame longer than that must retain() it. An unchanged frame, the subscriber's repeat
+    of the last one, is not copied again: its entry shares the previous entry's frame.
+    """
+
+    def __init__(self, hostname, source, slots=16, queue_size=2):
+        self.hostname = hostname
+        self.source = source
+        self.slots = slots
+        # seqs filed but not yet handed out by the hub, the oldest dropped when full
+        self.pending = collections.deque(maxlen=queue_size)
+        self.dropped = 0
+        self.buffer = None
+        self.entries = [None] * slots
+        self.seq = 0
+        self.written = 0
+        self.last_seen = 0.0
+        self._last_input = None
+        self._ready = Condition()
+
+    def put(self, msg, metadata, frame):
+        with self._ready:
+            slot = (self.seq + 1) % self.slots
+            if frame is self._last_input and self.entries[self.seq % self.slots] is not None:
+                frame = self.entries[self.seq % self.slots][3]
+            elif isinstance(frame, np.ndarray):
+                self._last_input = frame
+                if self.buffer is None or self.buffer.shape[1:] != frame.shape or self.buffer.dtype != frame.dtype:
+                    self.buffer = np.empty((self.slots,) + frame.shape, dtype=frame.dtype)
+                # pixels are only written for new frames, so repeats never see them change
+                self.written += 1
+                self.buffer[self.written % self.slots] = frame
+                frame = self.buffer[self.written % self.slots]
+            else:
+                self._last_input = frame
+                frame = retain(frame)
+            self.seq += 1
+            self.entries[slot] = (self.seq, msg, metadata, frame)
+            self.last_seen = time.time()
+            self._ready.notify_all()
+            return self.seq
+
+    def get(self, seq):
+        # the entry of frame seq, None once it has been overwritten
+        entry = self.entries[seq % self.slots]
+        return entry if entry is not None and entry[0] == seq else None
+
+    def wait(self, after_seq=0, timeout=None, latest=False):
+        # the frame following after_seq, or the newest one when latest; skips ahead to the
+        # oldest frame still in the ring when the consumer fell behind. None on timeout
+        with self._ready:
+            if not self._ready.wait_for(lambda: self.seq > after_seq, timeout=timeout):
+                return None
+            seq = self.seq if latest else max(after_seq + 1, self.seq - self.slots + 1)
+            return self.entries[seq % self.slots]
+
+class IngestHub():
+    """
+    Receives from many input-streamers in one process. Every source gets a receiving thread
+    that reconnects with exponential backoff when its streamer goes quiet; frames are filed
+    by the hostname in their metadata into one CameraRing per camera. receive() hands the
+    frames of all cameras to the processors in turn, from a small queue per camera so that
+    a busy camera only ever drops its own frames; subscribe() follows a single camera.
+    Under the lossless policy nothing is dropped: a camera whose queue is full holds its
+    receiving thread, leaving the backlog to the subscriber and then to zmq.
+    """
+
+    def __init__(self, sources, slots=16, keyframe_port=0, timeout=RECEIVE_TIMEOUT, max_backoff=30.0, queue_size=2, policy='latest'):
+        if policy == 'lossless' and slots <= queue_size + 1:
+            raise ValueError(f'lossless needs more ring slots than queued frames, got {slots} slots for a queue of {queue_size}')
+        self.sources = [parse_source(s) for s in sources]
+        self.policy = policy
+        self.slots = slots
+        self.keyframe_port = keyframe_port
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.queue_size = queue_size
+        self.cameras = {}
+        self.connected = {}
+        self._lock = Lock()
+        self._pending = Condition()
+        self._turn = 0
+        self._stop = Event()
+        self._threads = [Thread(target=self._run, args=source, daemon=True) for source in self.sources]
+        self.overwritten = REGISTRY.counter('identific_hub_overwritten_total', 'frames overwritten in their camera ring before they were processed')
+        REGISTRY.counter('identific_dropped_frames_total', 'frames dropped by a full queue',
+                         fn=lambda: sum(c.dropped for c in list(self.cameras.values())), queue='hub')
+        REGISTRY.gauge('identific_queue_depth', 'frames waiting in a queue',
+                       fn=lambda: sum(len(c.pending) for c in list(self.cameras.values())), queue='hub')
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _run(self, src_ip, src_port):
+        name = f'{src_ip}:{src_port}'
+        reconnects = REGISTRY.counter('identific_hub_reconnects_total', 'reconnections to a source', source=name)
+        REGISTRY.gauge('identific_hub_connected', 'whether a source is sending', fn=lambda: int(self.connected.get(name, False)), source=name)
+        backoff = 1.0
+        while not self._stop.is_set():
+            receiver = create_subscriber(src_ip, src_port, self.keyframe_port, self.policy)
+            try:
+                while not self._stop.is_set():
+                    seq, msg, metadata, frame = receiver.receive_sequenced(timeout=self.timeout)
+                    self.connected[name] = True
+                    backoff = 1.0
+                    self.file(name, msg, metadata, frame)
+            except TimeoutError:
+                print(f'no frames from {name} for {self.timeout:.0f}s, reconnecting in {backoff:.0f}s')
+            except Exception as e:
+                print(f'receiving from {name} failed: {e}, reconnecting in {backoff:.0f}s')
+            self.connected[name] = False
+            receiver.close()
+            reconnects.inc()
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def file(self, source, msg, metadata, frame):
+        hostname = metadata.get('hostname', source)
+        camera = self.cameras.get(hostname)
+        if camera is None:
+            with self._lock:
+                camera = self.cameras.setdefault(hostname, CameraRing(hostname, source, self.slots, self.queue_size))
+        if self.policy == 'lossless':
+            # wait for room before the ring slot is written, so queued frames are never overwritten
+            with self._pending:
+                self._pending.wait_for(lambda: len(camera.pending) < self.queue_size or self._stop.is_set())
+        seq = camera.put(msg, metadata, frame)
+        with self._pending:
+            if len(camera.pending) == camera.pending.maxlen:
+                camera.dropped += 1
+            camera.pending.append(seq)
+            self._pending.notify_all()
+
+    def next_pending(self, timeout):
+        # (camera, seq) from the cameras with frames waiting, taking turns
+        with self._pending:
+            if not self._pending.wait_for(lambda: any(c.pending for c in list(self.cameras.values())), timeout=timeout):
+                return None
+            cameras = list(self.cameras.values())
+            for i in range(len(cameras)):
+                camera = cameras[(self._turn + i) % len(cameras)]
+                if camera.pending:
+                    self._turn = (self._turn + i + 1) % len(cameras)
+                    seq = camera.pending.popleft()
+                    self._pending.notify_all()
+                    return camera, seq
+            return None
+
+    def receive(self, timeout=None):
+        # (hostname, msg, metadata, frame) of the next frame of any camera, None on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            item = self.next_pending(timeout=1.0 if deadline is None else max(0.0, deadline - time.monotonic()))
+            if item is None:
+                continue
+            camera, seq = item
+            entry = camera.get(seq)
+            if entry is None:
+                self.overwritten.inc()
+                continue
+            return (camera.hostname,) + entry[1:]
+        return None
+
+    def subscribe(self, hostname, after_seq=0, timeout=None, latest=True):
+        # the next (seq, msg, metadata, frame) of one camera, None if unknown or on timeout
+        camera = self.cameras.get(hostname)
+        return camera.wait(after_seq, timeout, latest) if camera else None
+
+    def request_keyframe(self, hostname):
+        camera = self.cameras.get(hostname)
+        if camera and self.keyframe_port:
+            request_keyframe(source_host(camera.source.rsplit(':', 1)[0]), self.keyframe_port)
+
+    def status(self):
+        return {hostname: dict(source=camera.source, frames=camera.seq, last_seen=camera.last_seen,
+                               connected=self.connected.get(camera.source, False))
+                for hostname, camera in list(self.cameras.items())}
+
+    def close(self):
+        self._stop.set()
+        with self._pending:
+            self._pending.notify_all()
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import threading
 import socket
 import datetime
 import traceback
@@ -11,23 +12,65 @@ import numpy as np
 from click.types import DateTime
 import imagezmq
 from imutils.video import VideoStream
-from utils import apply_transform, totuple, add_frame_tags
-from processors import VideoStreamSubscriber, FrameTagger
+from utils import apply_transform, compile_transform, totuple, add_frame_tags, RoiFrame
+from processors import VideoStreamSubscriber, FrameTagger, FrameQueue, MotionGate, DuplicateFilter, KeyframeRequests, send_frame
+from frame_metadata import encode_metadata
 from qr_extractor import extract
+from metrics import REGISTRY, stage_timer, metrics_application
+from shm_transport import ShmFrameSender, is_shm_address, SCHEME
+from werkzeug.serving import run_simple
+from recording import SegmentReplay
+from qos import QosController
+from ingest_hub import RECEIVE_TIMEOUT
 
 
 @click.command()
-@click.option('--src-type', default='v4l2', help='type of the input stream (v4l2, picamera, hubstream, netstream)')
-@click.option('--src-index', default='0', help='index or url of the device')
-@click.option('--dst-ip', default='127.0.0.1')
+@click.option('--src-type', default='v4l2', help='type of the input stream (v4l2, picamera, hubstream, netstream, replay)')
+@click.option('--src-index', default='0', help='index or url of the device, or the recording directory to replay')
+@click.option('--replay-speed', default=1.0, help='replay speed relative to the recording, 0 for as fast as possible')
+@click.option('--replay-from', default=None, help='start the replay at this epoch or YYYYmmddHHMMSS timestamp')
+@click.option('--replay-loop', is_flag=True, default=False, help='restart the replay when the recording ends')
+@click.option('--dst-ip', default='127.0.0.1', help='address to send to, or shm://<name> for shared memory on this host')
 @click.option('--dst-port', default=5555)
+@click.option('--codec', default='raw', type=click.Choice(['raw', 'jpg']), help='frame encoding on the wire')
+@click.option('--jpeg-quality', default=90, help='jpeg quality when --codec jpg')
+@click.option('--metadata', 'metadata_format', default='json', type=click.Choice(['json', 'binary']), help='frame metadata encoding on the wire')
 @click.option('--transform', default=None, help='a json array of operation and params')
 @click.option('--tagging', default='', help='available taggings: qrcode,plate,face')
+@click.option('--decode-qrcodes', is_flag=True, default=False, help='decode the payloads of the qr codes found, sent as payloads in the metadata')
+@click.option('--parallel-tagging', is_flag=True, default=False, help='run the enabled detectors concurrently')
+@click.option('--motion-gate', is_flag=True, default=False, help='only run detection on regions that changed')
+@click.option('--detect-every', default=1, help='run full detection every N frames and track objects in between')
+@click.option('--working-width', default=0, help='run the cascades on frames downscaled to this width, 0 for full resolution')
+@click.option('--detector-options', default=None, help='a json object of per detector min_size, max_size, scale_factor, scales, min_neighbors and roi')
+@click.option('--suppress-unchanged', is_flag=True, default=False, help='send frames without visible change as a short unchanged message')
+@click.option('--keyframe-every', default=10.0, help='with --suppress-unchanged, send a full frame at least every N seconds, below 15 unless --keyframe-port is set')
+@click.option('--roi-only', is_flag=True, default=False, help='send the tagged regions and a thumbnail instead of full frames')
+@click.option('--roi-padding', default=16, help='margin in pixels around each tagged region')
+@click.option('--thumbnail-width', default=320, help='width of the scene thumbnail sent with the regions')
+@click.option('--full-frame-every', default=30.0, help='with --roi-only, send a full frame at least every N seconds, 0 to only send them on request')
+@click.option('--keyframe-port', default=0, help='receivers push to this port to get a full frame next, 0 to disable')
+@click.option('--fps', default=10.0, help='target capture frame rate, 0 for as fast as possible')
+@click.option('--qos-budget', default=0, help='capture to send latency budget in ms, degrades tagging and frame rate to hold it, 0 to disable')
+@click.option('--queue-size', default=2, help='frames buffered between pipeline stages, oldest are dropped')
+@click.option('--metrics-port', default=0, help='serve pipeline metrics on this port, 0 to disable')
 @click.option('--xdebug', default=False, help='debug locally with an X server')
-def create_input_stream(src_type, src_index, dst_ip, dst_port, transform, tagging, xdebug):
+def create_input_stream(src_type, src_index, replay_speed, replay_from, replay_loop, dst_ip, dst_port, codec, jpeg_quality, metadata_format, transform, tagging, decode_qrcodes, parallel_tagging, motion_gate, detect_every, working_width, detector_options, suppress_unchanged, keyframe_every, roi_only, roi_padding, thumbnail_width, full_frame_every, keyframe_port, fps, qos_budget, queue_size, metrics_port, xdebug):
     
     hostname = socket.gethostname()
 
+    if queue_size < 1:
+        raise click.BadParameter(f'must be at least 1, got {queue_size}', param_hint='--queue-size')
+    # unchanged frames are only repeated once a receiver has a keyframe, one that (re)connects
+    # waits for the next keyframe and would time out before it without a keyframe port to ask on
+    if suppress_unchanged and not keyframe_port and keyframe_every >= RECEIVE_TIMEOUT:
+        raise click.BadParameter(f'must be below the {RECEIVE_TIMEOUT:.0f}s receive timeout of the stream processor '
+                                 'unless --keyframe-port is set', param_hint='--keyframe-every')
+
+    # parse and validate the transform spec once, frames only run the compiled pipeline;
+    # its output buffers are recycled once the send stage is done with them
+    transform = compile_transform(transform, buffers=queue_size + 2)
+
     # create a capture object from supported source
     if src_type =='v4l2':
         capture = VideoStream(src=int(src_index), usePiCamera=False)
@@ -42,49 +85,173 @@ def create_input_stream(src_type, src_index, dst_ip, dst_port, transform, taggin
         capture = VideoStream(best.url)
     elif src_type == 'hubstream':
         capture = VideoStreamSubscriber(hostname=src_index.split(':')[0], port=src_index.split(':')[1])
+    elif src_type == 'replay':
+        capture = SegmentReplay(src_index, speed=replay_speed, start=replay_from, loop=replay_loop)
     
     # create a sender object where to send captured data
-    sender = imagezmq.ImageSender(f'tcp://{dst_ip}:{dst_port}', REQ_REP=False)
+    if is_shm_address(dst_ip):
+        sender = ShmFrameSender(dst_ip[len(SCHEME):], dst_port, slots=queue_size + 6)
+    else:
+        sender = imagezmq.ImageSender(f'tcp://{dst_ip}:{dst_port}', REQ_REP=False)
 
     # create a tagger to do f= object detection
-    tagger = FrameTagger(tagging)
+    tagger = FrameTagger(tagging, parallel=parallel_tagging, motion_gate=MotionGate() if motion_gate else None, detect_every=detect_every,
+                         working_width=working_width, detector_options=detector_options, decode_qrcodes=decode_qrcodes)
 
-    # start capturing
-    capture.start()
-    time.sleep(2.0)          
+    keyframes = KeyframeRequests(keyframe_port) if keyframe_port else None
+    duplicates = DuplicateFilter(keyframe_every=keyframe_every) if suppress_unchanged else None
+    qos = QosController(qos_budget / 1000.0) if qos_budget > 0 else None
+
+    # capture, transform+tagging and sending run on their own threads, connected by
+    # drop-oldest queues so a slow stage never stalls capture and only fresh frames are sent
+    captured = FrameQueue(queue_size)
+    tagged = FrameQueue(queue_size)
+    stop = threading.Event()
+    for name, queue in (('captured', captured), ('tagged', tagged)):
+        REGISTRY.gauge('identific_queue_depth', 'frames waiting in a queue', fn=queue.__len__, queue=name)
+        REGISTRY.counter('identific_dropped_frames_total', 'frames dropped by a full queue', fn=lambda queue=queue: queue.dropped, queue=name)
+    frames_sent = REGISTRY.counter('identific_frames_sent_total', 'frames sent')
+    send_errors = REGISTRY.counter('identific_send_errors_total', 'frames that could not be sent')
+
+    def capture_frames():
+        # a replay paces itself on the recorded timestamps
+        period = 1.0 / fps if fps > 0 and src_type != 'replay' else 0
+        deadline = time.perf_counter()
+        count = 0
+        while not stop.is_set():
+            with stage_timer('capture'):
+                frame = capture.read()
+            if frame is not None:
+                count += 1
+                if not qos or qos.admit(count):
+                    captured.put((time.time(), time.monotonic_ns(), frame))
+            elif getattr(capture, 'finished', False):
+                # let the queued frames go out before shutting down
+                while len(captured) or len(tagged):
+                    time.sleep(0.05)
+                time.sleep(0.5)
+                print('replay finished')
+                stop.set()
+            deadline = max(deadline + period, time.perf_counter() - period)
+            time.sleep(max(0, deadline - time.perf_counter()))
+
+    def tag_frames():
+        seq = 0
+        tags = {}
+        last_full_frame = None
+        while not stop.is_set():
+            item = captured.get(timeout=0.5)
+            if item is None:
+                continue
+            timestamp, monotonic_ns, frame = item
+            seq += 1
+            with stage_timer('transform'):
+                frame = apply_transform(frame, transform)
+            output = frame
+            requested = keyframes is not None and keyframes.pending()
+            # unchanged frames, and frames skipped under qos, carry the tags of the last detection
+            unchanged = duplicates is not None and not duplicates.changed(frame) and not requested
+            if not unchanged and (not qos or qos.detect(seq)):
+                if qos:
+                    tagger.working_width = qos.working_width(working_width, frame.shape[1])
+                with stage_timer('tag'):
+                    tags = tagger.detect_frame_tags(frame)
 
-    try:
-        while True:
-            frame = capture.read()
-            print('original shape', frame.shape)
-            frame = apply_transform(frame, transform)
-            print('new shape', frame.shape)
-            tags = tagger.detect_frame_tags(frame)
-            
             if xdebug:
-                debug_frame = add_frame_tags(frame, tags)
+                debug_frame = add_frame_tags(frame.copy(), tags)
                 cv2.imshow('Capture detection', debug_frame)
                 cv2.waitKey(1)
 
             metadata = {
                 'hostname': hostname, 
-                'datetime': datetime.datetime.now().strftime('%Y%m%d%H%M%S.%f'),
+                'seq': seq,
                 'tags': tags,
             }
+            if metadata_format == 'binary':
+                metadata['time'] = timestamp
+                metadata['monotonic_ns'] = monotonic_ns
+            else:
+                metadata['datetime'] = datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d%H%M%S.%f')
+            if tagger.tracker:
+                metadata['tag_ids'] = tagger.tag_ids
+            if tagger.qr_decoder:
+                metadata['payloads'] = tagger.payloads
+            if qos:
+                metadata['qos'] = qos.level
+            if unchanged:
+                metadata['unchanged'] = True
+            elif roi_only:
+                now = time.monotonic()
+                if requested or last_full_frame is None or (full_frame_every > 0 and now - last_full_frame >= full_frame_every):
+                    last_full_frame = now
+                else:
+                    frame = RoiFrame.from_frame(frame, tags, padding=roi_padding, thumbnail_width=thumbnail_width)
+            tagged.put((metadata, frame, timestamp, output))
+
+    def send_frames():
+        while not stop.is_set():
+            item = tagged.get(timeout=0.5)
+            if item is None:
+                continue
+            metadata, frame, timestamp, output = item
             try:
-                sender.send_image(json.dumps(metadata, cls=npEncoder), frame)
+                with stage_timer('serialize'):
+                    if metadata_format == 'binary':
+                        msg = encode_metadata(metadata)
+                    else:
+                        msg = json.dumps(metadata, cls=npEncoder)
+                    jpg = None
+                    unchanged = metadata.get('unchanged', False)
+                    if codec == 'jpg' and isinstance(frame, RoiFrame):
+                        frame = frame.encode(jpeg_quality)
+                    elif codec == 'jpg' and not unchanged:
+                        jpg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1]
+                with stage_timer('send'):
+                    send_frame(sender, msg, frame, jpg, unchanged=unchanged)
+                frames_sent.inc()
+                if qos:
+                    qos.observe(time.time() - timestamp)
             except Exception as e:
+                send_errors.inc()
                 print(e, ':')
                 print(metadata)
-            time.sleep(0.1)
-    except Exception as ex:
-        print('exception caught:', ex)
-        capture.stop()
-        traceback.print_exc()
+            finally:
+                # roi crops are views into the transform output, it is free once sent
+                if transform:
+                    transform.release(output)
+
+    def run_stage(target):
+        try:
+            target()
+        except Exception as ex:
+            print('exception caught:', ex)
+            traceback.print_exc()
+            stop.set()
+
+    if metrics_port:
+        threading.Thread(target=run_simple, args=('0.0.0.0', metrics_port, metrics_application,), kwargs={'threaded': True}, daemon=True).start()
+
+    # start capturing
+    capture.start()
+    if src_type != 'replay':
+        time.sleep(2.0)          
+
+    stages = [threading.Thread(target=run_stage, args=(t,), daemon=True) for t in (capture_frames, tag_frames, send_frames)]
+    for stage in stages:
+        stage.start()
+    try:
+        while not stop.wait(timeout=1.0):
+            pass
+    except KeyboardInterrupt:
+        stop.set()
+    for stage in stages:
+        stage.join(timeout=2.0)
+    capture.stop()
+    tagger.close()
 
 class npEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, np.int32):
+        if isinstance(obj, np.integer):
             return int(obj)
         return json.JSONEncoder.default(self, obj)
 
@@ -0,0 +1,158 @@
+import time
+import datetime
+import bisect
+from threading import Lock
+from contextlib import contextmanager
+from werkzeug.wrappers import Request, Response
+
+# seconds, from a fast detector on a small frame up to a stalled stage
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter():
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.fn() if self.fn else self.value
+
+class Gauge():
+    """
+    Either set() explicitly or backed by a callable read at scrape time,
+    which keeps things like queue depths free on the hot path.
+    """
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name, labels, self.fn() if self.fn else self.value
+
+class Histogram():
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield name + '_bucket', labels + (('le', le),), cumulative
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, count
+
+class MetricsRegistry():
+    """
+    Process wide metrics, rendered in the Prometheus text format.
+    Metrics are created on first use and looked up by name and labels afterwards.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(**kwargs)
+                    self._help.setdefault(name, (help, cls.__name__.lower()))
+        return metric
+
+    def counter(self, name, help='', fn=None, **labels):
+        counter = self._get(Counter, name, help, labels)
+        if fn is not None:
+            counter.fn = fn
+        return counter
+
+    def gauge(self, name, help='', fn=None, **labels):
+        gauge = self._get(Gauge, name, help, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help='', **labels):
+        return self._get(Histogram, name, help, labels)
+
+    @contextmanager
+    def time(self, name, help='', **labels):
+        histogram = self.histogram(name, help, **labels)
+        start = time.perf_counter()
+        try:
+            yield histogram
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda item: item[0])
+        last_name = None
+        for (name, labels), metric in metrics:
+            if name != last_name:
+                help, kind = self._help[name]
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                last_name = name
+            for sample, sample_labels, value in metric.samples(name, labels):
+                if sample_labels:
+                    label_text = ','.join(f'{k}="{v}"' for k, v in sample_labels)
+                    lines.append(f'{sample}{{{label_text}}} {value}')
+                else:
+                    lines.append(f'{sample} {value}')
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+def stage_timer(stage):
+    return REGISTRY.time('identific_stage_seconds', 'per frame latency of a pipeline stage', stage=stage)
+
+def observe_frame(metadata):
+    # end to end latency from the capture timestamp, assumes the hosts clocks are in sync
+    hostname = metadata.get('hostname', '')
+    REGISTRY.counter('identific_frames_received_total', 'frames received', hostname=hostname).inc()
+    if 'time' in metadata:
+        latency = time.time() - metadata['time']
+    else:
+        try:
+            captured = datetime.datetime.strptime(metadata['datetime'], '%Y%m%d%H%M%S.%f')
+        except (KeyError, ValueError):
+            return
+        latency = (datetime.datetime.now() - captured).total_seconds()
+    REGISTRY.histogram('identific_end_to_end_seconds', 'capture to receive latency', hostname=hostname).observe(latency)
+
+def metrics_response():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@Request.application
+def metrics_application(request):
+    return metrics_response()
@@ -1,63 +1,619 @@
+import asyncio
 import datetime
 import os
+import math
+import collections
 import time
 import json
 import cv2
 import imagezmq
-from utils import rect_as_points
-from threading import Thread, Event
+import zmq
+from utils import JpegFrame, RoiFrame, as_image, as_jpeg, rect_as_points, rects_intersect, rect_iou, merge_rects
+from threading import Thread, Event, Condition, Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
 from time import perf_counter
 from codetiming import Timer
+from metrics import REGISTRY, stage_timer
+from qr_decoder import QrDecoder
+from frame_metadata import is_binary, parse_metadata, metadata_datetime, metadata_time
 
 import numpy as np
 
-# Helper class implementing an IO deamon thread
-class VideoStreamSubscriber:
+def recv_frame(receiver):
+    # imagezmq sends raw arrays with dtype/shape metadata and jpgs without, accept both;
+    # binary metadata travels as an extra message part instead of the json msg field.
+    # An unchanged frame comes without pixels and is returned as None
+    md = receiver.zmq_socket.recv_json()
+    with stage_timer('receive'):
+        msg = receiver.zmq_socket.recv() if md.get('meta') == 'bin' else md['msg']
+        buffer = receiver.zmq_socket.recv()
+        if md.get('unchanged'):
+            return msg, None
+        if 'roi' in md:
+            return msg, RoiFrame.unpack(md['roi'], buffer)
+        if 'shape' in md:
+            return msg, np.frombuffer(buffer, dtype=md['dtype']).reshape(md['shape'])
+        return msg, JpegFrame(buffer)
 
-    def __init__(self, hostname, port):
+def send_frame(sender, msg, image=None, jpg=None, unchanged=False):
+    if unchanged:
+        # only the metadata, receivers repeat the last frame they got
+        if hasattr(sender, 'send_unchanged'):
+            sender.send_unchanged(msg)
+            return
+        sender.zmq_socket.send_json(dict(meta='bin', unchanged=True) if is_binary(msg) else dict(msg=msg, unchanged=True), zmq.SNDMORE)
+        if is_binary(msg):
+            sender.zmq_socket.send(msg, zmq.SNDMORE)
+        sender.zmq_socket.send(b'')
+    elif isinstance(image, RoiFrame):
+        layout, payload = image.pack()
+        if hasattr(sender, 'send_roi'):
+            sender.send_roi(msg, layout, payload)
+            return
+        sender.zmq_socket.send_json(dict(meta='bin', roi=layout) if is_binary(msg) else dict(msg=msg, roi=layout), zmq.SNDMORE)
+        if is_binary(msg):
+            sender.zmq_socket.send(msg, zmq.SNDMORE)
+        sender.zmq_socket.send(payload, copy=False)
+    elif is_binary(msg) and hasattr(sender, 'zmq_socket'):
+        if jpg is not None:
+            md, payload = dict(meta='bin'), jpg
+        else:
+            payload = np.ascontiguousarray(image)
+            md = dict(meta='bin', dtype=str(payload.dtype), shape=payload.shape)
+        sender.zmq_socket.send_json(md, zmq.SNDMORE)
+        sender.zmq_socket.send(msg, zmq.SNDMORE)
+        # copied like imagezmq does, the frame may be a recycled buffer the caller writes again
+        sender.zmq_socket.send(payload)
+    elif jpg is not None:
+        sender.send_jpg(msg, jpg)
+    else:
+        sender.send_image(msg, image)
+
+class KeyframeRequests():
+    """
+    Sender side of keyframe requests: receivers that need a full frame, see request_keyframe,
+    push a message to this port and pending() tells the sender to send one.
+    """
+
+    def __init__(self, port):
+        self.socket = zmq.Context.instance().socket(zmq.PULL)
+        self.socket.bind(f'tcp://*:{port}')
+
+    def pending(self):
+        requested = False
+        while self.socket.poll(0):
+            self.socket.recv()
+            requested = True
+        return requested
+
+def request_keyframe(hostname, port):
+    socket = zmq.Context.instance().socket(zmq.PUSH)
+    socket.setsockopt(zmq.LINGER, 1000)
+    socket.connect(f'tcp://{hostname}:{port}')
+    socket.send(b'keyframe', zmq.NOBLOCK)
+    socket.close()
+
+class VideoStreamSubscriber():
+    """
+    Receives a stream on a daemon thread and hands out (msg, frame) pairs under one of two
+    policies: 'latest' keeps only the newest frame, older unread ones are dropped; 'lossless'
+    queues up to maxsize frames and stops reading while full, leaving the backlog to zmq.
+    Frames are numbered in arrival order, gaps in the sender's own seq are counted as lost
+    upstream. The metadata is parsed once, on arrival, and queued along with the frame. receive() blocks a thread, areceive() awaits in an asyncio event loop.
+    """
+
+    POLICIES = ('latest', 'lossless')
+
+    def __init__(self, hostname, port, policy='latest', maxsize=16):
+        if policy not in self.POLICIES:
+            raise ValueError(f'unknown subscriber policy {policy}, use one of {", ".join(self.POLICIES)}')
         self.hostname = hostname
         self.port = port
+        self.policy = policy
+        self._items = collections.deque(maxlen=1 if policy == 'latest' else None)
+        self.maxsize = 1 if policy == 'latest' else maxsize
+        self._ready = Condition()
+        self._waiters = set()
         self._stop = False
-        self._data_ready = Event()
         self._thread = Thread(target=self._run, args=())
         self._thread.daemon = True
         self.timer = Timer()
+        self._last = None
+        self.seq = 0
+        self.sender_seq = None
+        source = f'{hostname}:{port}'
+        self.received = REGISTRY.counter('identific_subscriber_received_total', 'frames received by a subscriber', source=source)
+        self.dropped = REGISTRY.counter('identific_subscriber_dropped_total', 'frames replaced before they were read', source=source)
+        self.gaps = REGISTRY.counter('identific_subscriber_gaps_total', 'frames missing from the sender sequence', source=source)
+        self.unchanged = REGISTRY.counter('identific_subscriber_unchanged_total', 'frames received as unchanged', source=source)
 
     def start(self):
         self._thread.start()
+        return self
 
     def receive(self, timeout=15.0):
-        flag = self._data_ready.wait(timeout=timeout)
-        if not flag:
-            raise TimeoutError(
-                "Timeout while reading from subscriber tcp://{}:{}".format(self.hostname, self.port))
-        self._data_ready.clear()
-        return self._data
+        seq, msg, metadata, frame = self.receive_sequenced(timeout)
+        return msg, frame
+
+    def receive_sequenced(self, timeout=15.0):
+        # (seq, msg, metadata, frame) of the next frame, seq counting every frame this subscriber received
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._items, timeout=timeout):
+                raise TimeoutError(
+                    "Timeout while reading from subscriber tcp://{}:{}".format(self.hostname, self.port))
+            item = self._items.popleft()
+            self._ready.notify_all()
+            return item
+
+    async def areceive(self, timeout=15.0):
+        # asyncio flavour of receive_sequenced: many streams and clients on one event loop,
+        # the receiving thread wakes the waiting coroutines through call_soon_threadsafe
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._ready:
+                if self._items:
+                    item = self._items.popleft()
+                    self._ready.notify_all()
+                    return item
+                waiter = loop.create_future()
+                self._waiters.add((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise TimeoutError(
+                    "Timeout while reading from subscriber tcp://{}:{}".format(self.hostname, self.port))
+            finally:
+                with self._ready:
+                    self._waiters.discard((loop, waiter))
 
     def read(self):
         msg, frame = self.receive()
-        return frame #cv2.imdecode(np.frombuffer(frame, dtype='uint8'), -1)
+        return as_image(frame)
 
     def _run(self):
         receiver = imagezmq.ImageHub("tcp://{}:{}".format(self.hostname, self.port), REQ_REP=False)
         while not self._stop:
-            self._data = receiver.recv_image() #.recv_jpg()
-            self._data_ready.set()
+            # poll so that close() ends the thread even when the sender is gone
+            if not receiver.zmq_socket.poll(1000):
+                continue
+            msg, frame = recv_frame(receiver)
+            frame = self.repeat(msg, frame)
+            if frame is not None:
+                self.deliver(msg, frame)
         receiver.close()
 
+    def deliver(self, msg, frame):
+        try:
+            metadata = parse_metadata(msg)
+        except ValueError as e:
+            print(f'dropping a frame from {self.hostname}:{self.port} with bad metadata: {e}')
+            return
+        self.count(metadata)
+        with self._ready:
+            if self.policy == 'lossless':
+                self._ready.wait_for(lambda: len(self._items) < self.maxsize or self._stop)
+            elif self._items:
+                self.dropped.inc()
+            self.seq += 1
+            self._items.append((self.seq, msg, metadata, frame))
+            self._ready.notify_all()
+            for loop, waiter in self._waiters:
+                loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+            self._waiters.clear()
+
+    def count(self, metadata):
+        self.received.inc()
+        self.advance(metadata)
+
+    def advance(self, metadata):
+        seq = metadata.get('seq')
+        if seq is None:
+            return
+        # a sequence going backwards is a restarted sender, not a gap
+        if self.sender_seq is not None and seq > self.sender_seq + 1:
+            self.gaps.inc(seq - self.sender_seq - 1)
+        self.sender_seq = seq
+
+    def repeat(self, msg, frame):
+        # an unchanged frame stands for the last one received, None until a keyframe arrived;
+        # one with nothing to repeat still takes its seq, it was not lost
+        if frame is not None:
+            self._last = frame
+            return frame
+        self.unchanged.inc()
+        if self._last is None:
+            self.skip(msg)
+        return self._last
+
+    def skip(self, msg):
+        # a frame that is not delivered is not a gap either
+        try:
+            self.advance(parse_metadata(msg))
+        except ValueError:
+            pass
+
     def close(self):
-        self._stop = True
+        with self._ready:
+            self._stop = True
+            self._ready.notify_all()
 
     def stop(self):
         self.close()
 
+class FrameQueue():
+    """
+    Bounded queue between pipeline stages. When full the oldest item is dropped,
+    so a slow consumer always gets the freshest frames and never stalls its producer.
+    """
+
+    def __init__(self, maxsize=2):
+        self._items = collections.deque(maxlen=maxsize)
+        self._ready = Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._ready:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._items, timeout=timeout):
+                return None
+            return self._items.popleft()
+
+    def __len__(self):
+        return len(self._items)
+
+class FrameBroadcaster():
+    """
+    Latest-frame slot shared by any number of MJPEG clients. Each client keeps the
+    sequence number it last sent and sleeps on the condition until a newer frame is
+    published. Clients ask for a variant, a width and a jpeg quality; each variant of a
+    frame is encoded at most once, by whichever of its clients asks first, so serving
+    many viewers costs one encode per variant instead of one per client.
+    """
+
+    def __init__(self, quality=95, max_age=100):
+        self.quality = quality
+        self.max_age = max_age
+        self._ready = Condition()
+        self._seq = 0
+        self._frame = None
+        self._variants = {}
+        self._variants_lock = Lock()
+
+    def publish(self, frame):
+        with self._ready:
+            if frame is self._frame:
+                # a repeated frame, clients already have it
+                return
+            self._seq += 1
+            self._frame = frame
+            self._ready.notify_all()
+
+    def latest(self):
+        with self._ready:
+            return self._seq, self._frame
+
+    def wait(self, last_seq, timeout=None, width=None, quality=None):
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._seq != last_seq, timeout=timeout):
+                return last_seq, None
+            seq, frame = self._seq, self._frame
+        return seq, self.encode(seq, frame, width, quality)
+
+    def variant(self, width=None, quality=None):
+        # snapped so that nearby requests share an encoding
+        if width:
+            width = max(64, int(width) // 16 * 16)
+        quality = self.quality if quality is None else min(95, max(10, int(quality) // 5 * 5))
+        return width or None, quality
+
+    def encode(self, seq, frame, width=None, quality=None):
+        variant = self.variant(width, quality)
+        with self._variants_lock:
+            # variants no client asked for in max_age frames are dropped
+            for stale in [v for v, entry in self._variants.items() if entry[1] < seq - self.max_age]:
+                del self._variants[stale]
+            entry = self._variants.setdefault(variant, [Lock(), 0, None])
+        with entry[0]:
+            if entry[1] < seq:
+                with stage_timer('encode'):
+                    entry[2] = self.encode_variant(frame, *variant)
+                entry[1] = seq
+            return entry[2]
+
+    def encode_variant(self, frame, width, quality):
+        if width is None and quality == self.quality:
+            # frames sent as jpg are forwarded as received
+            return as_jpeg(frame, quality)
+        image = as_image(frame)
+        if width and width < image.shape[1]:
+            image = cv2.resize(image, (width, round(image.shape[0] * width / image.shape[1])), interpolation=cv2.INTER_AREA)
+        return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+class MosaicComposer():
+    """
+    Composes the latest frames of several cameras into one grid, published to its own
+    FrameBroadcaster at most fps times a second. cameras() returns the (hostname, broadcaster)
+    pairs to show; a tile is only downscaled again when its camera has a new frame. The
+    composing thread stops once no client has read the mosaic for idle seconds, and is
+    started again by the next read.
+    """
+
+    def __init__(self, cameras, tile_width=320, fps=5.0, idle=30.0):
+        self.cameras = cameras
+        self.tile_width = tile_width
+        self.tile_height = tile_width * 9 // 16
+        self.fps = fps
+        self.idle = idle
+        self.broadcaster = FrameBroadcaster()
+        self.running = False
+        self.last_read = time.monotonic()
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            self.last_read = time.monotonic()
+            if not self.running:
+                self.running = True
+                Thread(target=self._run, daemon=True).start()
+        return self
+
+    def wait(self, last_seq, timeout=None, width=None, quality=None):
+        self.start()
+        return self.broadcaster.wait(last_seq, timeout, width, quality)
+
+    def _run(self):
+        try:
+            self.compose_frames()
+        finally:
+            # also when composing failed, so that the next read starts a new thread
+            with self._lock:
+                self.running = False
+
+    def compose_frames(self):
+        tiles = {}
+        while True:
+            # checked under the lock, a read racing the stop starts a new thread
+            with self._lock:
+                if time.monotonic() - self.last_read >= self.idle:
+                    return
+            started = time.monotonic()
+            cameras = self.cameras()
+            changed = False
+            for hostname, broadcaster in cameras:
+                seq, frame = broadcaster.latest()
+                if frame is None or tiles.get(hostname, (0, None))[0] == seq:
+                    continue
+                try:
+                    image = as_image(frame)
+                except Exception as e:
+                    print(f'mosaic skipped a frame of {hostname}: {e}')
+                    image = None
+                if image is None:
+                    # a frame that does not decode, the camera keeps its last tile
+                    tiles[hostname] = (seq, tiles.get(hostname, (0, None))[1])
+                    continue
+                tiles[hostname] = (seq, self.tile(hostname, image))
+                changed = True
+            if changed:
+                with stage_timer('mosaic'):
+                    self.broadcaster.publish(self.compose([tiles[h][1] for h, _ in cameras if tiles.get(h, (0, None))[1] is not None]))
+            time.sleep(max(0.0, 1.0 / self.fps - (time.monotonic() - started)))
+
+    def tile(self, hostname, image):
+        # the frame fitted into the tile, letterboxed, with the camera name
+        tile = np.zeros((self.tile_height, self.tile_width, 3), dtype=np.uint8)
+        h, w = image.shape[:2]
+        scale = min(self.tile_width / w, self.tile_height / h)
+        tw, th = max(1, int(w * scale)), max(1, int(h * scale))
+        scaled = cv2.resize(image, (tw, th), interpolation=cv2.INTER_AREA)
+        if scaled.ndim == 2:
+            scaled = cv2.cvtColor(scaled, cv2.COLOR_GRAY2BGR)
+        y, x = (self.tile_height - th) // 2, (self.tile_width - tw) // 2
+        tile[y:y + th, x:x + tw] = scaled
+        cv2.putText(tile, hostname, (6, 18), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+        return tile
+
+    def compose(self, tiles):
+        columns = max(1, math.ceil(math.sqrt(len(tiles))))
+        rows = max(1, math.ceil(len(tiles) / columns))
+        mosaic = np.zeros((rows * self.tile_height, columns * self.tile_width, 3), dtype=np.uint8)
+        for i, tile in enumerate(tiles):
+            y, x = (i // columns) * self.tile_height, (i % columns) * self.tile_width
+            mosaic[y:y + self.tile_height, x:x + self.tile_width] = tile
+        return mosaic
+
+class DuplicateFilter():
+    """
+    Tells whether a frame differs from the last keyframe, comparing gray thumbnails:
+    the frame changed when more than min_changed of the thumbnail pixels moved by more
+    than threshold levels. A keyframe is forced every keyframe_every seconds.
+    """
+
+    def __init__(self, width=96, threshold=8, min_changed=0.001, keyframe_every=10.0):
+        self.width = width
+        self.threshold = threshold
+        self.min_changed = min_changed
+        self.keyframe_every = keyframe_every
+        self.reference = None
+        self.keyframe_time = 0.0
+        self.suppressed = REGISTRY.counter('identific_unchanged_frames_total', 'frames sent as unchanged')
+
+    def changed(self, frame):
+        h, w = frame.shape[:2]
+        thumbnail = cv2.resize(frame, (self.width, max(1, h * self.width // w)), interpolation=cv2.INTER_AREA)
+        if thumbnail.ndim == 3:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+        now = time.monotonic()
+        # compared against the last keyframe rather than the last frame, so slow drift adds up
+        if self.reference is None or self.reference.shape != thumbnail.shape or now - self.keyframe_time >= self.keyframe_every \
+                or np.count_nonzero(cv2.absdiff(thumbnail, self.reference) > self.threshold) > self.min_changed * thumbnail.size:
+            self.reference = thumbnail
+            self.keyframe_time = now
+            return True
+        self.suppressed.inc()
+        return False
+
+class MotionGate():
+    """
+    Running-average background model on a downscaled gray copy of the frame.
+    regions() returns the padded bounding boxes of what changed, in full frame coordinates.
+    """
+
+    def __init__(self, width=320, alpha=0.05, threshold=25, min_area=0.0005, padding=24, full_frame_ratio=0.5):
+        self.width = width
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_area = min_area
+        self.padding = padding
+        self.full_frame_ratio = full_frame_ratio
+        self.background = None
+
+    def regions(self, frame):
+        h, w = frame.shape[:2]
+        scale = min(1.0, self.width / float(w))
+        small = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else frame
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+        if self.background is None or self.background.shape != small.shape:
+            self.background = small.astype(np.float32)
+            return [(0, 0, w, h)]
+
+        delta = cv2.absdiff(small, cv2.convertScaleAbs(self.background))
+        cv2.accumulateWeighted(small, self.background, self.alpha)
+        _, mask = cv2.threshold(delta, self.threshold, 255, cv2.THRESH_BINARY)
+        mask = cv2.dilate(mask, None, iterations=2)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        min_area = self.min_area * small.shape[0] * small.shape[1]
+        rects = []
+        for c in contours:
+            if cv2.contourArea(c) < min_area:
+                continue
+            x, y, rw, rh = cv2.boundingRect(c)
+            x0 = max(0, int(x / scale) - self.padding)
+            y0 = max(0, int(y / scale) - self.padding)
+            x1 = min(w, int((x + rw) / scale) + self.padding)
+            y1 = min(h, int((y + rh) / scale) + self.padding)
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+        rects = merge_rects(rects)
+        if sum(r[2] * r[3] for r in rects) > self.full_frame_ratio * w * h:
+            return [(0, 0, w, h)]
+        return rects
+
+class ObjectTracker():
+    """
+    Propagates tag polygons between detections with sparse Lucas-Kanade optical flow
+    and keeps a stable id per object. track() returns None when it lost confidence.
+    """
+
+    def __init__(self, min_confidence=0.5, max_features=20, match_iou=0.3):
+        self.min_confidence = min_confidence
+        self.max_features = max_features
+        self.match_iou = match_iou
+        self.tracks = []
+        self.next_id = 0
+        self.prev_gray = None
+
+    def update(self, frame_gray, tags):
+        # match fresh detections to existing tracks by overlap so objects keep their id
+        unmatched = list(self.tracks)
+        tracks = []
+        for name, found in tags.items():
+            for points in found:
+                polygon = np.array(points, dtype=np.float32)
+                rect = cv2.boundingRect(polygon)
+                best, best_iou = None, self.match_iou
+                for t in unmatched:
+                    if t['name'] == name:
+                        iou = rect_iou(rect, cv2.boundingRect(t['polygon']))
+                        if iou > best_iou:
+                            best, best_iou = t, iou
+                if best is not None:
+                    unmatched.remove(best)
+                    track_id = best['id']
+                else:
+                    track_id = self.next_id
+                    self.next_id += 1
+                tracks.append({'id': track_id, 'name': name, 'polygon': polygon,
+                               'features': self.features(frame_gray, rect)})
+        self.tracks = tracks
+        self.prev_gray = frame_gray
+
+    def features(self, frame_gray, rect):
+        x, y, w, h = rect
+        x0, y0 = max(0, x), max(0, y)
+        crop = frame_gray[y0:y+h, x0:x+w]
+        if crop.shape[0] < 3 or crop.shape[1] < 3:
+            return None
+        points = cv2.goodFeaturesToTrack(crop, self.max_features, 0.01, 3)
+        if points is None:
+            return None
+        return points + np.array([x0, y0], dtype=np.float32)
+
+    def track(self, frame_gray):
+        moving = [t for t in self.tracks if t['features'] is not None]
+        if moving:
+            previous = np.concatenate([t['features'] for t in moving])
+            current, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, frame_gray, previous, None)
+            back, back_status, _ = cv2.calcOpticalFlowPyrLK(frame_gray, self.prev_gray, current, None)
+            # forward-backward check: a good feature flows back to where it started
+            valid = (status.ravel() == 1) & (back_status.ravel() == 1) \
+                & (np.linalg.norm((back - previous).reshape(-1, 2), axis=1) < 1.0)
+            start = 0
+            for t in moving:
+                n = len(t['features'])
+                ok = valid[start:start+n]
+                if ok.sum() < 2 or ok.mean() < self.min_confidence:
+                    return None
+                shift = np.median((current[start:start+n] - previous[start:start+n]).reshape(-1, 2)[ok], axis=0)
+                t['polygon'] = t['polygon'] + shift
+                t['features'] = current[start:start+n][ok]
+                start += n
+        self.prev_gray = frame_gray
+        return self.tracks
+
 class FrameTagger():
+
+    # where the per detector timings are reported, None silences them
+    timer_logger = print
     
-    def __init__(self, tagging):
+    DETECTOR_OPTIONS = ('min_size', 'max_size', 'scale_factor', 'scales', 'min_neighbors', 'roi')
+
+    def __init__(self, tagging, parallel=False, motion_gate=None, detect_every=1, working_width=None, detector_options=None, decode_qrcodes=False):
         self.tagging = tagging
         self.detectors = {}
         self.timer = Timer()
+        # cascades run on a copy downscaled to working_width, with per detector
+        # expected object sizes (in frame pixels) and roi masks from detector_options
+        self.working_width = working_width or None
+        self.detector_options = self.validate_options(detector_options)
+        self._cascade_params = {}
+        self._roi_masks = {}
+        # optional MotionGate: unchanged frames reuse last_tags, changed ones only scan the moving regions
+        self.motion_gate = motion_gate
+        self.last_tags = {}
+        # with detect_every > 1 the detectors run every N frames and an ObjectTracker fills the gaps
+        self.detect_every = detect_every
+        self.tracker = ObjectTracker() if detect_every > 1 else None
+        self.tag_ids = {}
+        self.frames_since_detection = 0
         self.build_detectors()
+        # payloads of the qrcode tags, in the same order, when decoding is on
+        self.qr_decoder = QrDecoder() if decode_qrcodes and 'qrcode' in self.detectors else None
+        self.payloads = {}
+        # detectMultiScale/detectMulti release the GIL, so one persistent thread per detector
+        # lets them share the cores and a frame costs the slowest detector instead of the sum
+        self.pool = None
+        if parallel and len(self.detectors) > 1:
+            self.pool = ThreadPoolExecutor(max_workers=len(self.detectors), thread_name_prefix='tagger')
     
     def build_detectors(self):
         if 'qrcode' in self.tagging:
@@ -69,53 +625,285 @@ class FrameTagger():
             path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'assets', 'haarcascade_frontalface_alt.xml')
             self.detectors['face'] = cv2.CascadeClassifier(path)
     
+    @classmethod
+    def validate_options(cls, options):
+        # every option is checked and roi mask files are loaded here, so a bad value stops
+        # the tagger at startup instead of at its first frame
+        options = json.loads(options) if isinstance(options, str) else (options or {})
+        if not isinstance(options, dict) or not all(isinstance(opts, dict) for opts in options.values()):
+            raise ValueError('detector options must map detector names to option objects')
+        number = lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)
+        options = {name: dict(opts) for name, opts in options.items()}
+        for name, opts in options.items():
+            unknown = set(opts) - set(cls.DETECTOR_OPTIONS)
+            if unknown:
+                raise ValueError(f'unknown {name} detector options: {", ".join(sorted(unknown))}')
+            for key in ('min_size', 'max_size'):
+                if key in opts and not (isinstance(opts[key], (list, tuple)) and len(opts[key]) == 2
+                                        and all(number(v) and v > 0 for v in opts[key])):
+                    raise ValueError(f'{name} {key} must be a positive [width, height]')
+            if 'scales' in opts and not (number(opts['scales']) and opts['scales'] > 0):
+                raise ValueError(f'{name} scales must be a positive number')
+            if 'scale_factor' in opts and not (number(opts['scale_factor']) and opts['scale_factor'] > 1):
+                raise ValueError(f'{name} scale_factor must be a number above 1')
+            if 'min_neighbors' in opts and not (isinstance(opts['min_neighbors'], int) and opts['min_neighbors'] >= 0):
+                raise ValueError(f'{name} min_neighbors must be a non negative integer')
+            roi = opts.get('roi')
+            if isinstance(roi, str):
+                mask = cv2.imread(roi, cv2.IMREAD_GRAYSCALE)
+                if mask is None:
+                    raise ValueError(f'cannot read {name} roi mask {roi}')
+                opts['roi'] = mask
+            elif roi is not None and not (isinstance(roi, (list, tuple)) and len(roi) >= 3 and all(
+                    isinstance(p, (list, tuple)) and len(p) == 2 and all(number(v) for v in p) for p in roi)):
+                raise ValueError(f'{name} roi must be a mask image path or a polygon of [x, y] points')
+        return options
+
+    def cascade_params(self, name, scale):
+        params = self._cascade_params.get((name, scale))
+        if params is None:
+            opts = self.detector_options.get(name, {})
+            params = {}
+            min_size, max_size = opts.get('min_size'), opts.get('max_size')
+            if min_size:
+                params['minSize'] = (max(1, int(min_size[0] * scale)), max(1, int(min_size[1] * scale)))
+            if max_size:
+                params['maxSize'] = (max(1, int(max_size[0] * scale)), max(1, int(max_size[1] * scale)))
+            if 'scale_factor' in opts:
+                params['scaleFactor'] = float(opts['scale_factor'])
+            elif min_size and max_size:
+                # spread the requested number of pyramid levels over the expected size range
+                ratio = max(max_size[0] / float(min_size[0]), max_size[1] / float(min_size[1]))
+                params['scaleFactor'] = min(1.5, max(1.05, ratio ** (1.0 / opts.get('scales', 10))))
+            if 'min_neighbors' in opts:
+                params['minNeighbors'] = int(opts['min_neighbors'])
+            self._cascade_params[(name, scale)] = params
+        return params
+
+    def roi_mask(self, name, shape, scale):
+        key = (name, shape, scale)
+        if key not in self._roi_masks:
+            roi = self.detector_options.get(name, {}).get('roi')
+            mask = None
+            if isinstance(roi, np.ndarray):
+                # a mask image, loaded by validate_options
+                mask = cv2.resize(roi, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+                mask = cv2.threshold(mask, 0, 255, cv2.THRESH_BINARY)[1]
+            elif roi:
+                # a polygon in frame coordinates
+                mask = np.zeros(shape, dtype=np.uint8)
+                cv2.fillPoly(mask, [np.rint(np.array(roi, dtype=np.float64) * scale).astype(np.int32)], 255)
+            self._roi_masks[key] = None if mask is None else (mask, cv2.boundingRect(mask))
+        return self._roi_masks[key]
+
     def detect_frame_tags(self, frame):
-        tags = {}
+        tags = self.run_detectors(frame) if self.tracker is None else self.track_frame_tags(frame)
+        if self.qr_decoder:
+            with stage_timer('qr_decode'):
+                self.payloads = {'qrcode': self.qr_decoder.decode(frame, tags.get('qrcode', []))}
+        return tags
+
+    def track_frame_tags(self, frame):
         frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame_gray = cv2.equalizeHist(frame_gray)
-        if 'qrcode' in self.tagging:
-            with Timer(name='qrcode-dtc', text='{name} {milliseconds:.0f} ms'):
-                qrcodes = self.detectors['qrcode'].detectMulti(frame)
-                tags['qrcode'] = []
-                if qrcodes[0]:  # True
-                    for q in qrcodes[1]:
-                        tags['qrcode'].append(q.astype(np.int32).tolist()) #list(totuple(qrcodes[1][0].astype(np.int32)))
-        if 'plate' in self.tagging:
-            with Timer(name='plate-dtc', text='{name} {milliseconds:.0f} ms'):
-                plates = self.detectors['plate'].detectMultiScale(frame_gray)
-                tags['plate'] = []
-                for p in plates:
-                    tags['plate'].append(rect_as_points(p))
-        if 'face' in self.tagging:
-            with Timer(name='face-dtc', text='{name} {milliseconds:.0f} ms'):
-                faces = self.detectors['face'].detectMultiScale(frame_gray)
-                tags['face'] = []
-                for f in faces:
-                    tags['face'].append(rect_as_points(f)) #faces[0].tolist()                
+        tracks = None
+        if 0 < self.frames_since_detection < self.detect_every:
+            with Timer(name='track', text='{name} {milliseconds:.0f} ms', logger=self.timer_logger), stage_timer('track'):
+                tracks = self.tracker.track(frame_gray)
+        if tracks is None:
+            self.tracker.update(frame_gray, self.run_detectors(frame))
+            tracks = self.tracker.tracks
+            self.frames_since_detection = 0
+        self.frames_since_detection += 1
+
+        tags = {name: [] for name in self.detectors}
+        self.tag_ids = {name: [] for name in self.detectors}
+        for t in tracks:
+            tags[t['name']].append(np.rint(t['polygon']).astype(np.int32).tolist())
+            self.tag_ids[t['name']].append(t['id'])
+        return tags
+
+    def run_detectors(self, frame):
+        regions = None
+        if self.motion_gate:
+            regions = self.motion_gate.regions(frame)
+            if not regions:
+                return {name: list(found) for name, found in self.last_tags.items()}
+            if regions == [(0, 0, frame.shape[1], frame.shape[0])]:
+                regions = None
+
+        scale = 1.0
+        if self.working_width and frame.shape[1] > self.working_width:
+            scale = self.working_width / float(frame.shape[1])
+        frame_gray = None
+        if 'plate' in self.detectors or 'face' in self.detectors:
+            small = frame
+            if scale < 1.0:
+                small = cv2.resize(frame, (self.working_width, int(round(frame.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+            frame_gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            frame_gray = cv2.equalizeHist(frame_gray)
+        if self.pool:
+            futures = [(name, self.pool.submit(self.detect, name, frame, frame_gray, regions, scale)) for name in self.detectors]
+            tags = {name: future.result() for name, future in futures}
+        else:
+            tags = {name: self.detect(name, frame, frame_gray, regions, scale) for name in self.detectors}
+
+        if self.motion_gate:
+            if regions:
+                self.keep_static_tags(tags, regions)
+            self.last_tags = tags
         return tags
 
-def tag_dump(input_stack, output_dir='tag_dump/'):
-    print('created tag_dump')
-    while True:
+    def keep_static_tags(self, tags, regions):
+        # tags found earlier outside every changed region are still in view
+        for name, found in self.last_tags.items():
+            for points in found:
+                rect = cv2.boundingRect(np.array(points, dtype=np.int32))
+                if not any(rects_intersect(rect, r) for r in regions):
+                    tags[name].append(points)
+
+    def detect(self, name, frame, frame_gray, regions=None, scale=1.0):
+        with Timer(name=f'{name}-dtc', text='{name} {milliseconds:.0f} ms', logger=self.timer_logger), \
+                REGISTRY.time('identific_detector_seconds', 'per frame latency of a detector', detector=name):
+            # qrcodes need every pixel, only the cascades run on the downscaled working image
+            image, image_scale = (frame, 1.0) if name == 'qrcode' else (frame_gray, scale)
+            found = []
+            for region in regions or [None]:
+                found.extend(self.detect_region(name, image, region, image_scale))
+            return found
+
+    def detect_region(self, name, image, region=None, scale=1.0):
+        # region is in frame coordinates, image is the frame scaled by scale
+        h, w = image.shape[:2]
+        x0, y0, x1, y1 = 0, 0, w, h
+        if region is not None:
+            x, y, rw, rh = region
+            x0, y0 = int(x * scale), int(y * scale)
+            x1, y1 = min(w, int(math.ceil((x + rw) * scale))), min(h, int(math.ceil((y + rh) * scale)))
+        roi = self.roi_mask(name, (h, w), scale)
+        if roi is not None:
+            mx, my, mw, mh = roi[1]
+            x0, y0, x1, y1 = max(x0, mx), max(y0, my), min(x1, mx + mw), min(y1, my + mh)
+        if x1 <= x0 or y1 <= y0:
+            return []
+        crop = image[y0:y1, x0:x1]
+        if roi is not None:
+            crop = cv2.bitwise_and(crop, crop, mask=roi[0][y0:y1, x0:x1])
+
+        if name == 'qrcode':
+            found = []
+            qrcodes = self.detectors['qrcode'].detectMulti(crop)
+            if qrcodes[0]:  # True
+                for q in qrcodes[1]:
+                    found.append((q.astype(np.int32) + [x0, y0]).tolist()) #list(totuple(qrcodes[1][0].astype(np.int32)))
+            return found
+        rects = self.detectors[name].detectMultiScale(crop, **self.cascade_params(name, scale))
+        rects = np.asarray(rects, dtype=np.int32).reshape(-1, 4).tolist()
+        if scale == 1.0:
+            return [rect_as_points((x + x0, y + y0, rw, rh)) for x, y, rw, rh in rects]
+        return [rect_as_points((int(round((x + x0) / scale)), int(round((y + y0) / scale)), int(round(rw / scale)), int(round(rh / scale))))
+                for x, y, rw, rh in rects]
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+class TagDumper():
+    """
+    Writes a JPEG crop of every tag. Frames are handed over with put() and picked up
+    by a consumer thread as soon as they arrive; all crops of a frame are cut in one
+    pass and encoded/written by a worker pool whose backlog is bounded by max_pending.
+    Written crops are recorded in the DetectionIndex when one is given.
+    """
+
+    def __init__(self, output_dir='tag_dump/', workers=2, queue_size=32, max_pending=64, report_every=30.0, index=None):
+        self.output_dir = output_dir
+        self.index = index
+        self.report_every = report_every
+        self.frames = FrameQueue(queue_size)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tag_dump')
+        self.pending = BoundedSemaphore(max_pending)
+        self.written = 0
+        self.failed = 0
+        self._counter_lock = Lock()
+        self._stop = False
+        os.makedirs(output_dir, exist_ok=True)
+        self._thread = Thread(target=self._run, daemon=True)
+        REGISTRY.counter('identific_crops_written_total', 'tag crops written', fn=lambda: self.written)
+        REGISTRY.counter('identific_crops_failed_total', 'tag crops that could not be written', fn=lambda: self.failed)
+        REGISTRY.counter('identific_dropped_frames_total', 'frames dropped by a full queue', fn=lambda: self.dropped, queue='tag_dump')
+        REGISTRY.gauge('identific_queue_depth', 'frames waiting in a queue', fn=lambda: len(self.frames), queue='tag_dump')
+
+    def start(self):
+        self._thread.start()
+        if self.index:
+            self.index.start()
+        print('created tag_dump')
+        return self
+
+    def put(self, metadata, frame):
+        self.frames.put((metadata, frame))
+
+    @property
+    def dropped(self):
+        return self.frames.dropped
+
+    def _run(self):
+        last_report = time.perf_counter()
+        while not self._stop or len(self.frames):
+            item = self.frames.get(timeout=1.0)
+            if item is not None:
+                try:
+                    self.dump(*item)
+                except Exception as e:
+                    print('tag_dump failed on frame:', e)
+            if time.perf_counter() - last_report >= self.report_every:
+                last_report = time.perf_counter()
+                print(f'tag_dump written={self.written} failed={self.failed} dropped={self.dropped} pending={len(self.frames)}')
+
+    def dump(self, obj, frame):
+        tags = obj.get('tags')
+        if not tags or not any(len(found) for found in tags.values()):
+            return
+        image = as_image(frame)
+        h, w = image.shape[:2]
+        for tag, items in tags.items():
+            for cnt, coords in enumerate(items):
+                x, y, cw, ch = cv2.boundingRect(np.array(coords, dtype=np.int32))
+                x0, y0 = max(0, x), max(0, y)
+                cropped = image[y0:min(h, y+ch), x0:min(w, x+cw)]
+                if cropped.size == 0:
+                    continue
+                filename = f'{obj["hostname"]}-{metadata_datetime(obj)}-{tag}-{cnt}.jpg'
+                # copy the crop so the frame can be released while the write is queued;
+                # blocking on a full backlog makes the frame queue drop instead of memory growing
+                self.pending.acquire()
+                detection = (obj['hostname'], metadata_time(obj), tag, (x, y, cw, ch), filename)
+                self.pool.submit(self.write, os.path.join(self.output_dir, filename), cropped.copy(), detection)
+
+    def write(self, path, cropped, detection=None):
         try:
-            res = input_stack.pop()
-            if res:
-                obj = json.loads(res[0])
-                if 'tags' in obj:
-                    for tag in obj['tags']:
-                        cnt = 0
-                        for item in obj['tags'][tag]:
-                            #print(f'item-{tag}-{cnt} at {obj["tags"][tag][cnt]}')
-                            filename = f'{obj["hostname"]}-{obj["datetime"]}-{tag}-{cnt}.jpg'
-                            coords = obj['tags'][tag][cnt]
-                            print(filename, 'at', coords)
-                            x, y, w, h = cv2.boundingRect(np.array(coords))
-                            cropped = res[1][y:y+h,x:x+w]
-                            cv2.imwrite(output_dir+filename, cropped)
-                            cnt += 1
-                    #if len(obj['tags']['face']) > 0:
-                    #    for face in obj['tags']['face']:
-                    #        print(face)
+            ok = cv2.imwrite(path, cropped)
+            if ok and self.index and detection:
+                self.index.add(*detection)
+            with self._counter_lock:
+                if ok:
+                    self.written += 1
+                else:
+                    self.failed += 1
+            if not ok:
+                print('tag_dump could not write', path)
         except Exception as e:
-            pass #print(e)
-        time.sleep(0.1)
+            with self._counter_lock:
+                self.failed += 1
+            print('tag_dump could not write', path, e)
+        finally:
+            self.pending.release()
+
+    def close(self):
+        # dump the frames still queued, wait for their crops, then flush the index
+        self._stop = True
+        self._thread.join()
+        self.pool.shutdown(wait=True)
+        if self.index:
+            self.index.close()
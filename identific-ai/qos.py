@@ -0,0 +1,71 @@
+from threading import Lock
+from metrics import REGISTRY
+
+# degradation levels, each one keeps the savings of the previous ones
+FULL = 0
+SKIP_ALTERNATE = 1     # detectors run on every other frame, the others reuse the last tags
+LOW_RESOLUTION = 2     # detectors also run on a working image of half the width
+LOW_FRAME_RATE = 3     # every other captured frame is also dropped before tagging
+LEVELS = ('full', 'skip_alternate', 'low_resolution', 'low_frame_rate')
+
+
+class QosController():
+    """
+    Keeps capture to send latency within a per frame budget. observe() is fed the latency
+    of every sent frame; when its moving average stays over budget the pipeline degrades
+    one level, and when it stays well under budget it recovers one level. Every change
+    waits cooldown frames so its effect shows in the average before the next one.
+    """
+
+    def __init__(self, budget, alpha=0.2, patience=5, recover_ratio=0.6, recover_patience=30, cooldown=10, min_width=160):
+        self.budget = budget
+        self.alpha = alpha
+        self.patience = patience
+        self.recover_ratio = recover_ratio
+        self.recover_patience = recover_patience
+        self.cooldown = cooldown
+        self.min_width = min_width
+        self.level = FULL
+        self.latency = None
+        self._over = 0
+        self._under = 0
+        self._wait = 0
+        self._lock = Lock()
+        REGISTRY.gauge('identific_qos_level', 'current quality of service degradation level', fn=lambda: self.level)
+        self.changes = {direction: REGISTRY.counter('identific_qos_changes_total', 'quality of service level changes', direction=direction)
+                        for direction in ('degrade', 'recover')}
+
+    def observe(self, latency):
+        with self._lock:
+            self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+            if self._wait > 0:
+                self._wait -= 1
+                return
+            self._over = self._over + 1 if self.latency > self.budget else 0
+            self._under = self._under + 1 if self.latency < self.budget * self.recover_ratio else 0
+            if self._over >= self.patience and self.level < LOW_FRAME_RATE:
+                self.change(self.level + 1, 'degrade')
+            elif self._under >= self.recover_patience and self.level > FULL:
+                self.change(self.level - 1, 'recover')
+
+    def change(self, level, direction):
+        print(f'qos {direction} to {LEVELS[level]}, latency {self.latency * 1000:.0f} ms, budget {self.budget * 1000:.0f} ms')
+        self.level = level
+        self._over = self._under = 0
+        self._wait = self.cooldown
+        self.changes[direction].inc()
+
+    def admit(self, count):
+        # capture side, whether the count-th captured frame goes down the pipeline
+        return self.level < LOW_FRAME_RATE or count % 2 == 0
+
+    def detect(self, seq):
+        # tagging side, whether the detectors run on frame seq
+        return self.level < SKIP_ALTERNATE or seq % 2 == 0
+
+    def working_width(self, configured, frame_width):
+        # the detection working width for the current level, configured being the tagger's own
+        if self.level < LOW_RESOLUTION:
+            return configured
+        width = configured or frame_width
+        return max(self.min_width, min(width, frame_width) // 2)
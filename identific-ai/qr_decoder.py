@@ -0,0 +1,129 @@
+import hashlib
+import collections
+import cv2
+import numpy as np
+from metrics import REGISTRY
+
+try:
+    from pyzbar import pyzbar
+except ImportError:
+    pyzbar = None
+
+VERSIONS = range(1, 11)    # qr versions recognized by the cache, 21 to 57 modules a side
+MIN_TIMING = 0.9   # share of the timing pattern a grid must match to be cached
+MARGIN = 16        # quiet zone kept around each code in the pyzbar mosaic
+
+
+def sample_modules(gray, polygon, size):
+    # the code warped to size x size modules, True for a dark module
+    side = size * 8
+    dst = np.array([[0, 0], [side, 0], [side, side], [0, side]], dtype=np.float32)
+    warped = cv2.warpPerspective(gray, cv2.getPerspectiveTransform(polygon, dst), (side, side))
+    # the middle of every module, its edges blur into the neighbours
+    grid = warped.reshape(size, 8, size, 8)[:, 2:6, :, 2:6].mean(axis=(1, 3)).astype(np.uint8)
+    return grid <= cv2.threshold(grid, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0]
+
+def timing_score(modules):
+    # how well row and column 6 alternate between the finder patterns, as they do at the right size
+    size = modules.shape[0]
+    expected = np.arange(8, size - 8) % 2 == 0
+    return (np.mean(modules[6, 8:size - 8] == expected) + np.mean(modules[8:size - 8, 6] == expected)) / 2
+
+def read_modules(gray, polygon):
+    # the module grid of the code at its own version, None when no version fits
+    score, modules = max(((timing_score(m), m) for m in (sample_modules(gray, polygon, 17 + 4 * v) for v in VERSIONS)),
+                         key=lambda found: found[0])
+    return modules if score >= MIN_TIMING else None
+
+
+class QrDecoder():
+    """
+    Decodes the payloads of the qr codes located in a frame. The codes missing from the cache
+    are decoded together in one call, pyzbar on a mosaic of their crops when it is installed,
+    cv2.QRCodeDetector.decodeMulti on their polygons otherwise. A decoded code is cached with
+    its position and its module grid, sampled at the version its timing pattern shows; a code
+    found near a cached one is sampled at that grid's size and reuses the payload when only a
+    few modules differ, so a label in view is decoded once and a label swapped in place is not
+    mistaken for the previous one.
+    """
+
+    def __init__(self, cache_size=1024, radius=32, max_distance=0.08):
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.radius = radius
+        self.max_distance = max_distance
+        self.detector = cv2.QRCodeDetector()
+        self.hits = REGISTRY.counter('identific_qr_cache_total', 'qr payload lookups', result='hit')
+        self.misses = REGISTRY.counter('identific_qr_cache_total', 'qr payload lookups', result='miss')
+
+    def decode(self, frame, polygons):
+        # one payload per polygon, None when the code could not be read
+        if len(polygons) == 0:
+            return []
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        polygons = [np.asarray(p, dtype=np.float32).reshape(4, 2) for p in polygons]
+        payloads = [self.lookup(gray, p) for p in polygons]
+        missing = [i for i, payload in enumerate(payloads) if payload is None]
+        self.hits.inc(len(polygons) - len(missing))
+        if missing:
+            self.misses.inc(len(missing))
+            decoded = self.decode_batch(gray, [polygons[i] for i in missing])
+            for i, payload in zip(missing, decoded):
+                payloads[i] = payload
+                if payload is not None:
+                    self.store(gray, polygons[i], payload)
+        return payloads
+
+    def lookup(self, gray, polygon):
+        center = polygon.mean(axis=0)
+        for key, (cached_center, modules, payload) in reversed(self.cache.items()):
+            if np.abs(cached_center - center).max() > self.radius:
+                continue
+            if np.mean(sample_modules(gray, polygon, modules.shape[0]) != modules) <= self.max_distance:
+                self.cache.move_to_end(key)
+                return payload
+        return None
+
+    def store(self, gray, polygon, payload):
+        modules = read_modules(gray, polygon)
+        if modules is None:
+            return
+        center = polygon.mean(axis=0)
+        key = (tuple((center // self.radius).astype(int)), hashlib.blake2b(np.packbits(modules).tobytes(), digest_size=8).digest())
+        self.cache[key] = (center, modules, payload)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def decode_batch(self, gray, polygons):
+        if pyzbar is not None:
+            return self.decode_mosaic(gray, polygons)
+        try:
+            ok, decoded, _ = self.detector.decodeMulti(gray, np.array(polygons, dtype=np.float32))
+        except cv2.error:
+            ok = False
+        if not ok:
+            return [None] * len(polygons)
+        return [payload or None for payload in decoded]
+
+    def decode_mosaic(self, gray, polygons):
+        # the crops side by side on a white canvas, each symbol found is matched to its crop by position
+        h, w = gray.shape[:2]
+        crops, spans, x = [], [], 0
+        for polygon in polygons:
+            bx, by, bw, bh = cv2.boundingRect(polygon.astype(np.int32))
+            x0, y0 = max(0, bx - MARGIN), max(0, by - MARGIN)
+            crop = gray[y0:min(h, by + bh + MARGIN), x0:min(w, bx + bw + MARGIN)]
+            crops.append(crop)
+            spans.append((x, x + crop.shape[1]))
+            x += crop.shape[1] + MARGIN
+        mosaic = np.full((max(c.shape[0] for c in crops), x), 255, dtype=np.uint8)
+        for crop, (x0, x1) in zip(crops, spans):
+            mosaic[:crop.shape[0], x0:x1] = crop
+        payloads = [None] * len(polygons)
+        for symbol in pyzbar.decode(mosaic, symbols=[pyzbar.ZBarSymbol.QRCODE]):
+            center = symbol.rect.left + symbol.rect.width / 2.0
+            for i, (x0, x1) in enumerate(spans):
+                if x0 <= center < x1 and payloads[i] is None:
+                    payloads[i] = symbol.data.decode('utf-8', errors='replace')
+        return payloads
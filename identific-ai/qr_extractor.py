@@ -11,20 +11,31 @@ WARP_DIM = 300
 SMALL_DIM = 29
 
 
-def count_children(hierarchy, parent, inner=False):
+def count_children(hierarchy, parent, inner=False, limit=None):
+    # iterative walk over next-sibling/first-child links, recursion overflows on busy frames
     if parent == -1:
         return 0
-    elif not inner:
-        return count_children(hierarchy, hierarchy[parent][2], True)
-    return 1 + count_children(hierarchy, hierarchy[parent][0], True) + count_children(hierarchy, hierarchy[parent][2], True)
+    stack = [parent] if inner else [hierarchy[parent][2]]
+    count = 0
+    while stack:
+        node = stack.pop()
+        if node == -1:
+            continue
+        count += 1
+        if limit is not None and count >= limit:
+            break
+        stack.append(hierarchy[node][0])
+        stack.append(hierarchy[node][2])
+    return count
 
 
 def has_square_parent(hierarchy, squares, parent):
-    if hierarchy[parent][3] == -1:
-        return False
-    if hierarchy[parent][3] in squares:
-        return True
-    return has_square_parent(hierarchy, squares, hierarchy[parent][3])
+    parent = hierarchy[parent][3]
+    while parent != -1:
+        if parent in squares:
+            return True
+        parent = hierarchy[parent][3]
+    return False
 
 
 def get_center(c):
@@ -43,15 +54,11 @@ def get_midpoint(p1, p2):
 
 
 def get_farthest_points(contour, center):
-    distances = []
-    distances_to_points = {}
-    for point in contour:
-        point = point[0]
-        d = math.hypot(point[0] - center[0], point[1] - center[1])
-        distances.append(d)
-        distances_to_points[d] = point
-    distances = sorted(distances)
-    return [distances_to_points[distances[-1]], distances_to_points[distances[-2]]]
+    points = contour.reshape(-1, 2)
+    distances = np.hypot(points[:, 0] - center[0], points[:, 1] - center[1])
+    ranked = np.sort(distances)
+    # as with a distance -> point dict, the last point at a given distance wins
+    return [points[np.flatnonzero(distances == d)[-1]] for d in (ranked[-1], ranked[-2])]
 
 
 def line_intersection(line1, line2):
@@ -82,7 +89,7 @@ def extend(a, b, length, int_represent=False):
         return result
 
 
-def extract(frame, debug=False):
+def extract(frame, debug=False, locate=False):
     output = frame.copy()
 
     # Remove noise and unnecessary contours from frame
@@ -92,9 +99,10 @@ def extract(frame, debug=False):
     edged = cv2.Canny(gray, 30, 200)
 
     contours, hierarchy = cv2.findContours(edged.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    tree = hierarchy[0].tolist() if hierarchy is not None else []
 
     squares = []
-    square_indices = []
+    square_indices = set()
 
     i = 0
     for c in contours:
@@ -106,9 +114,9 @@ def extract(frame, debug=False):
         # Find all quadrilateral contours
         if len(approx) == 4:
             # Determine if quadrilateral is a square to within SQUARE_TOLERANCE
-            if area > 25 and 1 - SQUARE_TOLERANCE < math.fabs((peri / 4) ** 2) / area < 1 + SQUARE_TOLERANCE and count_children(hierarchy[0], i) >= 2 and has_square_parent(hierarchy[0], square_indices, i) is False:
+            if area > 25 and 1 - SQUARE_TOLERANCE < math.fabs((peri / 4) ** 2) / area < 1 + SQUARE_TOLERANCE and count_children(tree, i, limit=2) >= 2 and has_square_parent(tree, square_indices, i) is False:
                 squares.append(approx)
-                square_indices.append(i)
+                square_indices.add(i)
         i += 1
 
     main_corners = []
@@ -116,85 +124,88 @@ def extract(frame, debug=False):
     south_corners = []
     tiny_squares = []
     rectangles = []
+
+    # Per square measurements, computed once
+    areas = np.array([cv2.contourArea(s) for s in squares], dtype=np.float64)
+    peris = np.array([cv2.arcLength(s, True) for s in squares], dtype=np.float64)
+    centers = np.array([get_center(s) for s in squares], dtype=np.int64).reshape(-1, 2)
+    first_x = np.array([s[0][0][0] for s in squares])
+
+    # Pairwise matrices, row i compares square i with every other square
+    others = first_x[:, None] != first_x[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        area_diff = np.abs(areas[:, None] - areas[None, :]) / np.maximum(areas[:, None], areas[None, :])
+    # Determine if square is similar to other square within AREA_TOLERANCE
+    similar_mask = others & (area_diff <= AREA_TOLERANCE)
+    tiny_mask = others & ~similar_mask & (peris[:, None] / 4 / 2 > peris[None, :] / 4)
+    deltas = centers[:, None, :] - centers[None, :, :]
+    distances = np.hypot(deltas[..., 0], deltas[..., 1])
+
     # Determine if squares are QR codes
-    for square in squares:
-        area = cv2.contourArea(square)
-        center = get_center(square)
-        peri = cv2.arcLength(square, True)
-
-        similar = []
-        tiny = []
-        for other in squares:
-            if square[0][0][0] != other[0][0][0]:
-                # Determine if square is similar to other square within AREA_TOLERANCE
-                if math.fabs(area - cv2.contourArea(other)) / max(area, cv2.contourArea(other)) <= AREA_TOLERANCE:
-                    similar.append(other)
-                elif peri / 4 / 2 > cv2.arcLength(other, True) / 4:
-                    tiny.append(other)
-
-        if len(similar) >= 2:
-            distances = []
-            distances_to_contours = {}
-            for sim in similar:
-                sim_center = get_center(sim)
-                d = math.hypot(sim_center[0] - center[0], sim_center[1] - center[1])
-                distances.append(d)
-                distances_to_contours[d] = sim
-            distances = sorted(distances)
-            closest_a = distances[-1]
-            closest_b = distances[-2]
-
-            # Determine if this square is the top left QR code indicator
-            if max(closest_a, closest_b) < cv2.arcLength(square, True) * 2.5 and math.fabs(closest_a - closest_b) / max(closest_a, closest_b) <= DISTANCE_TOLERANCE:
-                # Determine placement of other indicators (even if code is rotated)
-                angle_a = get_angle(get_center(distances_to_contours[closest_a]), center)
-                angle_b = get_angle(get_center(distances_to_contours[closest_b]), center)
-                if angle_a < angle_b or (angle_b < -90 and angle_a > 0):
-                    east = distances_to_contours[closest_a]
-                    south = distances_to_contours[closest_b]
-                else:
-                    east = distances_to_contours[closest_b]
-                    south = distances_to_contours[closest_a]
-                midpoint = get_midpoint(get_center(east), get_center(south))
-                # Determine location of fourth corner
-                # Find closest tiny indicator if possible
-                min_dist = 10000
-                t = []
-                tiny_found = False
-                if len(tiny) > 0:
-                    for tin in tiny:
-                        tin_center = get_center(tin)
-                        d = math.hypot(tin_center[0] - midpoint[0], tin_center[1] - midpoint[1])
-                        if d < min_dist:
-                            min_dist = d
-                            t = tin
-                    tiny_found = len(t) > 0 and min_dist < peri
-
-                diagonal = peri / 4 * 1.41421
-
-                if tiny_found:
-                    # Easy, corner is just a few blocks away from the tiny indicator
-                    tiny_squares.append(t)
-                    offset = extend(midpoint, get_center(t), peri / 4 * 1.41421)
-                else:
-                    # No tiny indicator found, must extrapolate corner based off of other corners instead
-                    farthest_a = get_farthest_points(distances_to_contours[closest_a], center)
-                    farthest_b = get_farthest_points(distances_to_contours[closest_b], center)
-                    # Use sides of indicators to determine fourth corner
-                    offset = line_intersection(farthest_a, farthest_b)
-                    if offset[0] == -1:
-                        # Error, extrapolation failed, go on to next possible code
-                        continue
-                    offset = extend(midpoint, offset, peri / 4 / 7)
-                    if debug:
-                        cv2.line(output, (farthest_a[0][0], farthest_a[0][1]), (farthest_a[1][0], farthest_a[1][1]), (0, 0, 255), 4)
-                        cv2.line(output, (farthest_b[0][0], farthest_b[0][1]), (farthest_b[1][0], farthest_b[1][1]), (0, 0, 255), 4)
-
-                # Append rectangle, offsetting to farthest borders
-                rectangles.append([extend(midpoint, center, diagonal / 2, True), extend(midpoint, get_center(distances_to_contours[closest_b]), diagonal / 2, True), offset, extend(midpoint, get_center(distances_to_contours[closest_a]), diagonal / 2, True)])
-                east_corners.append(east)
-                south_corners.append(south)
-                main_corners.append(square)
+    for i, square in enumerate(squares):
+        similar = np.flatnonzero(similar_mask[i])
+        if len(similar) < 2:
+            continue
+        center = centers[i].tolist()
+        peri = peris[i]
+
+        d = distances[i, similar]
+        ranked = np.sort(d)
+        closest_a = ranked[-1]
+        closest_b = ranked[-2]
+        # as with a distance -> contour dict, the last contour at a given distance wins
+        contour_a = similar[np.flatnonzero(d == closest_a)[-1]]
+        contour_b = similar[np.flatnonzero(d == closest_b)[-1]]
+
+        # Determine if this square is the top left QR code indicator
+        if closest_a > 0 and max(closest_a, closest_b) < peri * 2.5 and math.fabs(closest_a - closest_b) / max(closest_a, closest_b) <= DISTANCE_TOLERANCE:
+            # Determine placement of other indicators (even if code is rotated)
+            angle_a = get_angle(centers[contour_a].tolist(), center)
+            angle_b = get_angle(centers[contour_b].tolist(), center)
+            if angle_a < angle_b or (angle_b < -90 and angle_a > 0):
+                east = contour_a
+                south = contour_b
+            else:
+                east = contour_b
+                south = contour_a
+            midpoint = get_midpoint(centers[east].tolist(), centers[south].tolist())
+            # Determine location of fourth corner
+            # Find closest tiny indicator if possible
+            tiny = np.flatnonzero(tiny_mask[i])
+            t = None
+            tiny_found = False
+            if len(tiny) > 0:
+                tiny_distances = np.hypot(centers[tiny, 0] - midpoint[0], centers[tiny, 1] - midpoint[1])
+                k = int(np.argmin(tiny_distances))
+                if tiny_distances[k] < 10000:
+                    t = tiny[k]
+                    tiny_found = tiny_distances[k] < peri
+
+            diagonal = peri / 4 * 1.41421
+
+            if tiny_found:
+                # Easy, corner is just a few blocks away from the tiny indicator
+                tiny_squares.append(squares[t])
+                offset = extend(midpoint, centers[t].tolist(), peri / 4 * 1.41421)
+            else:
+                # No tiny indicator found, must extrapolate corner based off of other corners instead
+                farthest_a = get_farthest_points(squares[contour_a], center)
+                farthest_b = get_farthest_points(squares[contour_b], center)
+                # Use sides of indicators to determine fourth corner
+                offset = line_intersection(farthest_a, farthest_b)
+                if offset[0] == -1:
+                    # Error, extrapolation failed, go on to next possible code
+                    continue
+                offset = extend(midpoint, offset, peri / 4 / 7)
+                if debug:
+                    cv2.line(output, (farthest_a[0][0], farthest_a[0][1]), (farthest_a[1][0], farthest_a[1][1]), (0, 0, 255), 4)
+                    cv2.line(output, (farthest_b[0][0], farthest_b[0][1]), (farthest_b[1][0], farthest_b[1][1]), (0, 0, 255), 4)
+
+            # Append rectangle, offsetting to farthest borders
+            rectangles.append([extend(midpoint, center, diagonal / 2, True), extend(midpoint, centers[contour_b].tolist(), diagonal / 2, True), offset, extend(midpoint, centers[contour_a].tolist(), diagonal / 2, True)])
+            east_corners.append(squares[east])
+            south_corners.append(squares[south])
+            main_corners.append(square)
 
     codes = []
     i = 0
@@ -233,4 +244,7 @@ def extract(frame, debug=False):
         cv2.drawContours(output, south_corners, -1, (128, 0, 0), 2)
         cv2.drawContours(output, tiny_squares, -1, (128, 128, 0), 2)
 
+    if locate:
+        # the corners of every code, in the same order as codes
+        return codes, output, [np.rint(rect).astype(int).tolist() for rect in rectangles]
     return codes, output
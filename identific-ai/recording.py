@@ -0,0 +1,206 @@
+import os
+import time
+import glob
+import cv2
+import numpy as np
+from threading import Thread
+from utils import JpegFrame, as_image
+from processors import FrameQueue
+from frame_metadata import is_binary, parse_timestamp, metadata_time
+from metrics import REGISTRY
+
+# a recording is a directory of segments: <start ms>.dat holds the metadata and frame
+# bytes back to back, <start ms>.idx one fixed size INDEX_DTYPE record per frame
+INDEX_DTYPE = np.dtype([
+    ('seq', '<u8'),
+    ('time', '<f8'),
+    ('offset', '<u8'),
+    ('meta_len', '<u4'),
+    ('frame_len', '<u4'),
+    ('flags', '<u4'),
+    ('height', '<u4'),
+    ('width', '<u4'),
+    ('channels', '<u4'),
+])
+FLAG_JPG = 1
+FLAG_BINARY_META = 2
+ALIGN = 64
+
+
+class SegmentRecorder():
+    """
+    Stream-processor sink appending every frame and its metadata to chunked segment
+    files, rolled over by size or duration. Frames are written by a background thread
+    fed through a FrameQueue, so a slow disk drops frames instead of stalling receive.
+    """
+
+    def __init__(self, directory='recordings/', segment_bytes=256 * 1024 * 1024, segment_seconds=60.0, queue_size=32):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.frames = FrameQueue(queue_size)
+        self.seq = 0
+        self._data = None
+        self._index = None
+        self._started = 0.0
+        self._last_time = 0.0
+        self._stop = False
+        os.makedirs(directory, exist_ok=True)
+        self.written = REGISTRY.counter('identific_frames_recorded_total', 'frames written to the recording')
+        REGISTRY.counter('identific_dropped_frames_total', 'frames dropped by a full queue', fn=lambda: self.frames.dropped, queue='record')
+        REGISTRY.gauge('identific_queue_depth', 'frames waiting in a queue', fn=lambda: len(self.frames), queue='record')
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print('recording to', self.directory)
+        return self
+
+    def put(self, msg, metadata, frame):
+        self.frames.put((time.time(), msg, metadata, frame))
+
+    def _run(self):
+        while not self._stop:
+            item = self.frames.get(timeout=1.0)
+            if item is not None:
+                try:
+                    self.write(*item)
+                except Exception as e:
+                    print('recording failed on frame:', e)
+        self.close_segment()
+
+    def open_segment(self, timestamp):
+        self.close_segment()
+        name = os.path.join(self.directory, f'{int(timestamp * 1000):015d}')
+        self._data = open(name + '.dat', 'ab')
+        self._index = open(name + '.idx', 'ab')
+        self._started = timestamp
+
+    def close_segment(self):
+        if self._data:
+            self._data.close()
+            self._index.close()
+            self._data = self._index = None
+
+    def capture_time(self, received, metadata):
+        # the camera's capture time, as in the detection index, arrival time when the sender
+        # gave none; kept non decreasing so that seeking in the index stays a binary search
+        try:
+            timestamp = metadata_time(metadata)
+        except (KeyError, ValueError, TypeError):
+            timestamp = received
+        self._last_time = max(self._last_time, timestamp)
+        return self._last_time
+
+    def write(self, received, msg, metadata, frame):
+        timestamp = self.capture_time(received, metadata)
+        if self._data is None or self._data.tell() >= self.segment_bytes or timestamp - self._started >= self.segment_seconds:
+            self.open_segment(timestamp)
+        meta = bytes(msg) if is_binary(msg) else msg.encode()
+        record = np.zeros((), dtype=INDEX_DTYPE)
+        flags = 0
+        if isinstance(frame, JpegFrame):
+            payload = memoryview(frame.jpg)
+            flags |= FLAG_JPG
+        else:
+            payload = np.ascontiguousarray(as_image(frame))
+            shape = payload.shape + (1,) * (3 - payload.ndim)
+            record['height'], record['width'], record['channels'] = shape
+        if is_binary(msg):
+            flags |= FLAG_BINARY_META
+        record['flags'] = flags
+        self.seq += 1
+        offset = self._data.tell()
+        record['seq'] = self.seq
+        record['time'] = timestamp
+        record['offset'] = offset
+        record['meta_len'] = len(meta)
+        record['frame_len'] = payload.nbytes
+        self._data.write(meta)
+        self._data.write(payload)
+        # pad so every frame starts aligned in the memory map
+        padding = -(len(meta) + payload.nbytes) % ALIGN
+        self._data.write(b'\0' * padding)
+        self._data.flush()
+        # the index entry goes last, a reader never sees a frame that is not fully written
+        self._index.write(record.tobytes())
+        self._index.flush()
+        self.written.inc()
+
+    def close(self):
+        self._stop = True
+        self._thread.join(timeout=5.0)
+
+class SegmentReplay():
+    """
+    Replays a recording with the VideoStream interface. Segments are memory-mapped and
+    raw frames are returned as views into the map. read() blocks until the next frame
+    is due: speed 1.0 is real time, 2.0 twice as fast, 0 as fast as possible.
+    """
+
+    def __init__(self, directory, speed=1.0, start=None, loop=False):
+        self.directory = directory
+        self.speed = speed
+        self.loop = loop
+        self.finished = False
+        self.metadata = None
+        self.segments = []
+        for index_path in sorted(glob.glob(os.path.join(directory, '*.idx'))):
+            count = os.path.getsize(index_path) // INDEX_DTYPE.itemsize
+            if count == 0:
+                continue
+            index = np.memmap(index_path, dtype=INDEX_DTYPE, mode='r', shape=(count,))
+            # copy-on-write, so consumers drawing on a frame never touch the file
+            data = np.memmap(index_path[:-4] + '.dat', dtype=np.uint8, mode='c')
+            self.segments.append((index, data))
+        if not self.segments:
+            raise ValueError(f'no recording found in {directory}')
+        # global position -> (segment, row), and the capture time of every frame for seeking
+        self.positions = [(s, r) for s, (index, _) in enumerate(self.segments) for r in range(len(index))]
+        self.times = np.concatenate([index['time'] for index, _ in self.segments])
+        self.first = self.seek(start) if start is not None else 0
+        if self.first >= len(self.positions):
+            raise ValueError(f'nothing recorded in {directory} after {start}')
+        self.position = self.first
+        self._clock = None
+
+    def seek(self, timestamp):
+        self.position = int(np.searchsorted(self.times, parse_timestamp(timestamp)))
+        self._clock = None
+        return self.position
+
+    def start(self):
+        return self
+
+    def read(self):
+        if self.position >= len(self.positions):
+            if not self.loop:
+                self.finished = True
+                return None
+            self.position = self.first
+            self._clock = None
+        recorded = self.times[self.position]
+        if self.speed > 0:
+            if self._clock is None:
+                self._clock = (time.perf_counter(), recorded)
+            due = self._clock[0] + (recorded - self._clock[1]) / self.speed
+            time.sleep(max(0.0, due - time.perf_counter()))
+        segment, row = self.positions[self.position]
+        self.position += 1
+        return self.frame(segment, row)
+
+    def frame(self, segment, row):
+        index, data = self.segments[segment]
+        entry = index[row]
+        start = int(entry['offset'])
+        meta = data[start:start + int(entry['meta_len'])]
+        self.metadata = meta.tobytes() if entry['flags'] & FLAG_BINARY_META else meta.tobytes().decode()
+        start += int(entry['meta_len'])
+        payload = data[start:start + int(entry['frame_len'])]
+        if entry['flags'] & FLAG_JPG:
+            return cv2.imdecode(payload, cv2.IMREAD_COLOR)
+        frame = payload.reshape(int(entry['height']), int(entry['width']), int(entry['channels']))
+        return frame[:, :, 0] if entry['channels'] == 1 else frame
+
+    def stop(self):
+        self.finished = True
@@ -0,0 +1,173 @@
+import os
+import atexit
+import zmq
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from utils import JpegFrame, RoiFrame, retain
+from frame_metadata import is_binary
+from processors import VideoStreamSubscriber
+from metrics import REGISTRY, stage_timer
+
+# every ring slot starts with the int64 sequence number of the frame it holds, -1 while being written
+HEADER = 8
+SCHEME = 'shm://'
+
+
+def is_shm_address(address):
+    return str(address).startswith(SCHEME)
+
+def attach_segment(name):
+    # only the sender owns the segment; keep the resource tracker of readers from unlinking it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def close_segment(shm):
+    # False while frames still point into the segment, try again later
+    try:
+        shm.close()
+        return True
+    except BufferError:
+        return False
+
+class ShmFrameSender():
+    """
+    Drop-in for imagezmq.ImageSender between processes on the same host. Frames are
+    copied once into a ring of slots in shared memory and only a small json message
+    with the sequence number and slot location goes over a local zmq PUB socket.
+    """
+
+    def __init__(self, name, port, slots=8):
+        self.name = name
+        self.slots = slots
+        self.socket = zmq.Context.instance().socket(zmq.PUB)
+        self.socket.bind(f'tcp://127.0.0.1:{port}')
+        self.shm = None
+        self.headers = None
+        self.slot_bytes = 0
+        self.generation = 0
+        self.seq = 0
+        atexit.register(self.close)
+
+    def ring(self, nbytes):
+        # (re)allocate when the first frame arrives or a frame outgrows the slots
+        if self.shm is None or HEADER + nbytes > self.slot_bytes:
+            self.release()
+            self.generation += 1
+            self.slot_bytes = HEADER + (nbytes + 63) // 64 * 64
+            self.shm = shared_memory.SharedMemory(name=f'identific-{self.name}-{os.getpid()}-{self.generation}',
+                                                  create=True, size=self.slot_bytes * self.slots)
+            self.headers = np.ndarray((self.slots,), dtype=np.int64, buffer=self.shm.buf, strides=(self.slot_bytes,))
+            self.headers[:] = -1
+        return self.shm
+
+    def write(self, msg, payload, **md):
+        shm = self.ring(payload.nbytes)
+        self.seq += 1
+        slot = self.seq % self.slots
+        offset = slot * self.slot_bytes
+        self.headers[slot] = -1
+        np.ndarray(payload.shape, dtype=payload.dtype, buffer=shm.buf, offset=offset + HEADER)[...] = payload
+        self.headers[slot] = self.seq
+        md.update(seq=self.seq, segment=shm.name, offset=offset)
+        if is_binary(msg):
+            self.socket.send_json(dict(meta='bin', **md), zmq.SNDMORE)
+            self.socket.send(msg)
+        else:
+            self.socket.send_json(dict(msg=msg, **md))
+
+    def send_image(self, msg, image):
+        self.write(msg, image, shape=image.shape, dtype=str(image.dtype))
+
+    def send_jpg(self, msg, jpg_buffer):
+        jpg = np.frombuffer(jpg_buffer, dtype=np.uint8)
+        self.write(msg, jpg, nbytes=jpg.nbytes, jpg=True)
+
+    def send_roi(self, msg, layout, payload):
+        self.write(msg, payload, nbytes=payload.nbytes, roi=layout)
+
+    def send_unchanged(self, msg):
+        # no slot is written, so the last frame stays readable in the ring
+        if is_binary(msg):
+            self.socket.send_json(dict(meta='bin', unchanged=True), zmq.SNDMORE)
+            self.socket.send(msg)
+        else:
+            self.socket.send_json(dict(msg=msg, unchanged=True))
+
+    def release(self):
+        if self.shm is not None:
+            self.headers = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def close(self):
+        self.release()
+        self.socket.close(linger=0)
+
+class ShmVideoStreamSubscriber(VideoStreamSubscriber):
+    """
+    Receiving end of ShmFrameSender. Frames are numpy views into the shared ring, not
+    copies: they stay valid until the sender wraps around the ring, consumers that keep
+    a frame longer than that must copy it. Frames already overwritten are counted and skipped.
+    When the sender moves to a new ring the old segment is closed once no frame uses it.
+    The lossless policy copies frames out of the ring, its queue may outlive the ring's slots.
+    """
+
+    def __init__(self, name, port, policy='latest', maxsize=16):
+        super().__init__(name, port, policy, maxsize)
+        self.overwritten = REGISTRY.counter('identific_shm_overwritten_total', 'frames overwritten before they were read', segment=name)
+
+    def _run(self):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'')
+        socket.setsockopt(zmq.RCVTIMEO, 1000)
+        socket.connect(f'tcp://127.0.0.1:{self.port}')
+        segments = {}
+        retired = []
+        while not self._stop:
+            try:
+                md = socket.recv_json()
+            except zmq.Again:
+                continue
+            with stage_timer('receive'):
+                msg = socket.recv() if md.get('meta') == 'bin' else md['msg']
+                if md.get('unchanged'):
+                    frame = self.repeat(msg, None)
+                    if frame is not None:
+                        self.deliver(msg, frame)
+                    continue
+                shm = segments.get(md['segment'])
+                if shm is None:
+                    retired += segments.values()
+                    segments.clear()
+                    shm = segments[md['segment']] = attach_segment(md['segment'])
+                if retired:
+                    retired = [old for old in retired if not close_segment(old)]
+                offset = md['offset'] + HEADER
+                header = np.ndarray((), dtype=np.int64, buffer=shm.buf, offset=md['offset'])
+                if int(header) != md['seq']:
+                    self.overwritten.inc()
+                    self.skip(msg)
+                    continue
+                if 'roi' in md:
+                    frame = RoiFrame.unpack(md['roi'], shm.buf[offset:offset + md['nbytes']])
+                elif md.get('jpg'):
+                    frame = JpegFrame(shm.buf[offset:offset + md['nbytes']])
+                else:
+                    frame = np.ndarray(md['shape'], dtype=md['dtype'], buffer=shm.buf, offset=offset)
+                if self.policy == 'lossless':
+                    frame = retain(frame)
+                    # the slot could have been reused while it was copied
+                    if int(header) != md['seq']:
+                        self.overwritten.inc()
+                        self.skip(msg)
+                        continue
+            self.deliver(msg, self.repeat(msg, frame))
+        socket.close(linger=0)
+        for shm in retired + list(segments.values()):
+            close_segment(shm)
+
@@ -1,97 +1,197 @@
 import sys
+import json
 import cv2
 from imutils.video import VideoStream
 import imagezmq
 import threading
 import numpy as np
+import time
 from time import sleep
-import collections
 import traceback
 import click
 from werkzeug.wrappers import Request, Response
 from werkzeug.serving import run_simple
-from processors import tag_dump
+from processors import TagDumper, send_frame, request_keyframe, FrameBroadcaster, MosaicComposer
+from frame_metadata import parse_metadata, encode_metadata, is_binary
+from ingest_hub import IngestHub, parse_source, source_host
+from utils import retain, JpegFrame
+from tag_farm import TagFarm
+from recording import SegmentRecorder
+from detection_index import DetectionIndex, detections_response
+import os
+from metrics import observe_frame, metrics_response, metrics_application
 
-frame_stack = collections.deque([], maxlen=10)
+broadcaster = FrameBroadcaster()
+broadcasters = {}
+mosaics = {}
+MAX_MOSAICS = 8
+mosaic_fps = 5.0
+mosaics_lock = threading.Lock()
+hub = None
+detections_db = 'tag_dump/detections.db'
+keyframe_source = None
 
 @click.command()
-@click.option('--src-ip', default='127.0.0.1')
+@click.option('--src-ip', default='127.0.0.1', help='address to receive from, or shm://<name> for shared memory on this host')
 @click.option('--src-port', default=5555)
-@click.option('--processor', default='')
-def create_stream_processor(src_ip, src_port, processor):
-    receiver = VideoStreamSubscriber(src_ip, src_port)
-    if processor == 'web':
-        x = threading.Thread(target=run_simple, args=('0.0.0.0', 4000, application,), daemon=True)
+@click.option('--source', multiple=True, help='ip:port or shm://name:port to receive from, repeat for every camera; replaces --src-ip/--src-port')
+@click.option('--ring-slots', default=16, help='frames kept per camera')
+@click.option('--policy', default='latest', type=click.Choice(['latest', 'lossless']), help='latest skips frames the processors could not keep up with, lossless holds the receiving threads until they catch up')
+@click.option('--processor', default='', help='web, dump, tag or record')
+@click.option('--metrics-port', default=0, help='serve metrics on this port when the web processor is not running, 0 to disable')
+@click.option('--tagging', default='qrcode,plate,face', help='taggings run by the tag processor')
+@click.option('--decode-qrcodes', is_flag=True, default=False, help='the tag processor also decodes the payloads of the qr codes found')
+@click.option('--tag-workers', default=os.cpu_count(), help='local tag worker processes, 0 to only use remote tag_farm.py workers')
+@click.option('--farm-port', default=5570, help='tag workers pull frames from this port and push results to the next one')
+@click.option('--reorder-window', default=16, help='tagging results buffered to restore frame order')
+@click.option('--dst-ip', default='127.0.0.1', help='where the tag processor sends the tagged frames')
+@click.option('--dst-port', default=5556)
+@click.option('--keyframe-port', default=0, help='keyframe port of the input-streamer, to ask for a full frame on connect and for every new web client')
+@click.option('--detections-db', 'db_path', default=detections_db, help='detection index the dump processor writes and the web processor queries, empty to disable')
+@click.option('--record-dir', default='recordings/', help='where the record processor writes its segments')
+@click.option('--segment-seconds', default=60.0, help='start a new recording segment after this many seconds')
+@click.option('--segment-mb', default=256, help='start a new recording segment after this many megabytes')
+@click.option('--mosaic-fps', 'mosaic_rate', default=mosaic_fps, help='frame rate of the /mosaic views composed from several cameras')
+def create_stream_processor(src_ip, src_port, source, ring_slots, policy, processor, metrics_port, tagging, decode_qrcodes, tag_workers, farm_port, reorder_window, dst_ip, dst_port, keyframe_port, db_path, record_dir, segment_seconds, segment_mb, mosaic_rate):
+    global detections_db, keyframe_source, hub, mosaic_fps
+    detections_db = db_path
+    mosaic_fps = mosaic_rate
+    sources = list(source) or [f'{src_ip}:{src_port}']
+    hub = IngestHub(sources, slots=ring_slots, keyframe_port=keyframe_port, policy=policy).start()
+    if keyframe_port and len(sources) == 1:
+        keyframe_source = (source_host(parse_source(sources[0])[0]), keyframe_port)
+    web = processor == 'web'
+    if web:
+        x = threading.Thread(target=run_simple, args=('0.0.0.0', 4000, application,), kwargs={'threaded': True}, daemon=True)
         x.start()
-    elif processor == 'dump':
-        x = threading.Thread(target=tag_dump, args=(frame_stack,), daemon=True)
+    elif metrics_port:
+        x = threading.Thread(target=run_simple, args=('0.0.0.0', metrics_port, metrics_application,), kwargs={'threaded': True}, daemon=True)
         x.start()
-    while True:
-        try:
-            msg, frame = receiver.receive()
-            #print(msg)
-            frame_stack.append((msg, frame))
-        except TimeoutError as ex:
-            print('Timeout error, streamer is gone ... sleep 5s and re-establish connection !')
-            receiver.close()
-            sleep(1)
-            receiver = VideoStreamSubscriber(src_ip, src_port)
-        except Exception as ex:
-            print('Python error with no Exception handler:')
-            print('Traceback error:', ex)
-            traceback.print_exc()
-            receiver.close()
-            sys.exit()
-
-def sendImagesToWeb():
-    while True:
-        try:
-            camName, frame = frame_stack.pop()#receiver.recv_image()
-            # add visual indicator of detected stuff
-            # for (x,y,w,h) in plates:
-            #     center = (x + w//2, y + h//2)
-            #     frame = cv2.ellipse(frame, center, (w//2, h//2), 0, 0, 360, (255, 0, 255), 4)
-            #     faceROI = frame_gray[y:y+h,x:x+w]            
-            jpg = cv2.imencode('.jpg', frame)[1]
-            yield b'--frame\r\nContent-Type:image/jpeg\r\n\r\n'+jpg.tostring()+b'\r\n'    
-        except Exception as e:
-            pass
+    dumper = None
+    if processor == 'dump':
+        dumper = TagDumper(index=DetectionIndex(detections_db) if detections_db else None).start()
+    recorder = None
+    if processor == 'record':
+        recorder = SegmentRecorder(record_dir, segment_bytes=segment_mb * 1024 * 1024, segment_seconds=segment_seconds).start()
+    farm = None
+    if processor == 'tag':
+        farm = create_tag_farm(tagging, tag_workers, farm_port, reorder_window, dst_ip, dst_port, decode_qrcodes)
+    # the hub reconnects lost sources on its own; frames are views into the camera
+    # rings, so consumers that hold on to them past this loop get a copy
+    try:
+        while True:
+            try:
+                hostname, msg, metadata, frame = hub.receive()
+                observe_frame(metadata)
+                if web:
+                    camera_broadcaster(hostname).publish(frame)
+                    if len(sources) == 1:
+                        broadcaster.publish(frame)
+                if dumper and any(len(found) for found in metadata.get('tags', {}).values()):
+                    # frames without tags have nothing to dump, queueing them would push tagged ones out
+                    dumper.put(metadata, retain(frame))
+                if recorder:
+                    recorder.put(msg, metadata, retain(frame))
+                if farm:
+                    farm.submit(msg, retain(frame))
+            except Exception as ex:
+                print('Python error with no Exception handler:')
+                print('Traceback error:', ex)
+                traceback.print_exc()
+                sys.exit()
+    finally:
+        # flush the queued crops and the last batch of detections before exiting
+        hub.close()
+        if dumper:
+            dumper.close()
+        if recorder:
+            recorder.close()
 
-@Request.application
-def application(request):
-    return Response(sendImagesToWeb(), mimetype='multipart/x-mixed-replace; boundary=frame')
+def create_tag_farm(tagging, workers, farm_port, window, dst_ip, dst_port, decode_qrcodes=False):
+    sender = imagezmq.ImageSender(f'tcp://{dst_ip}:{dst_port}', REQ_REP=False)
 
+    def send_tagged(msg, frame, tags, payloads):
+        metadata = parse_metadata(msg)
+        metadata.setdefault('tags', {}).update(tags)
+        if payloads:
+            metadata.setdefault('payloads', {}).update(payloads)
+        msg = encode_metadata(metadata) if is_binary(msg) else json.dumps(metadata)
+        if isinstance(frame, JpegFrame):
+            send_frame(sender, msg, jpg=frame.jpg)
+        else:
+            send_frame(sender, msg, frame)
 
-# Helper class implementing an IO deamon thread
-class VideoStreamSubscriber:
+    return TagFarm(tagging, send_tagged, workers=workers, farm_port=farm_port, window=window, decode_qrcodes=decode_qrcodes)
 
-    def __init__(self, hostname, port):
-        self.hostname = hostname
-        self.port = port
-        self._stop = False
-        self._data_ready = threading.Event()
-        self._thread = threading.Thread(target=self._run, args=())
-        self._thread.daemon = True
-        self._thread.start()
+def camera_broadcaster(hostname):
+    if hostname not in broadcasters:
+        broadcasters.setdefault(hostname, FrameBroadcaster())
+    return broadcasters[hostname]
 
-    def receive(self, timeout=15.0):
-        flag = self._data_ready.wait(timeout=timeout)
-        if not flag:
-            raise TimeoutError(
-                "Timeout while reading from subscriber tcp://{}:{}".format(self.hostname, self.port))
-        self._data_ready.clear()
-        return self._data
+def mosaic(hostnames, tile_width):
+    # one composer per camera list and tile size, shared by all of its clients; every one
+    # runs a thread, so keys are normalized and at most MAX_MOSAICS run. None when full
+    key = (tuple(sorted(set(hostnames))), max(64, min(1920, tile_width)) // 16 * 16)
+    with mosaics_lock:
+        for stale in [k for k, composer in mosaics.items() if not composer.running and k != key]:
+            del mosaics[stale]
+        if key not in mosaics:
+            if len(mosaics) >= MAX_MOSAICS:
+                return None
+            cameras = lambda: [(h, broadcasters[h]) for h in (key[0] or sorted(broadcasters)) if h in broadcasters]
+            mosaics[key] = MosaicComposer(cameras, key[1], mosaic_fps)
+        return mosaics[key].start()
 
-    def _run(self):
-        receiver = imagezmq.ImageHub("tcp://{}:{}".format(self.hostname, self.port), REQ_REP=False)
-        while not self._stop:
-            self._data = receiver.recv_image()
-            self._data_ready.set()
-        receiver.close()
+def sendImagesToWeb(broadcaster, hostnames=(), width=None, quality=None, max_fps=None):
+    # every client reads the shared latest frame, so viewers neither steal frames
+    # from each other nor from the dump processor, and each variant of a frame is
+    # encoded once; frames sent with --codec jpg are forwarded as received, without
+    # a decode, to clients of the default variant. max_fps skips frames for slow clients
+    seq = 0
+    for hostname in hostnames:
+        hub.request_keyframe(hostname)
+    if not hostnames and keyframe_source:
+        request_keyframe(*keyframe_source)
+    interval = 1.0 / max_fps if max_fps else 0.0
+    while True:
+        started = time.monotonic()
+        seq, jpg = broadcaster.wait(seq, timeout=15.0, width=width, quality=quality)
+        if jpg is not None:
+            yield b'--frame\r\nContent-Type:image/jpeg\r\n\r\n'+jpg+b'\r\n'
+            sleep(max(0.0, interval - (time.monotonic() - started)))
 
-    def close(self):
-        self._stop = True
+def stream_response(request, broadcaster, hostnames=()):
+    # ?width=&quality=&fps= pick the variant a client receives
+    frames = sendImagesToWeb(broadcaster, hostnames, width=request.args.get('width', type=int),
+                             quality=request.args.get('quality', type=int), max_fps=request.args.get('fps', type=float))
+    return Response(frames, mimetype='multipart/x-mixed-replace; boundary=frame')
 
+@Request.application
+def application(request):
+    if request.path == '/metrics':
+        return metrics_response()
+    if request.path.startswith('/detections'):
+        if not detections_db:
+            return Response('detection index disabled', status=404)
+        return detections_response(request, detections_db)
+    if request.path == '/cameras' or (request.path == '/' and len(hub.sources) > 1):
+        return Response(json.dumps(hub.status()), mimetype='application/json')
+    if request.path.startswith('/camera/'):
+        hostname = request.path[len('/camera/'):]
+        if hostname not in broadcasters:
+            return Response(f'unknown camera {hostname}', status=404)
+        return stream_response(request, broadcasters[hostname], (hostname,))
+    if request.path == '/mosaic':
+        # ?cameras=a,b&tile=320, every camera when none are given
+        hostnames = [h for h in request.args.get('cameras', '').split(',') if h]
+        unknown = [h for h in hostnames if h not in broadcasters]
+        if unknown:
+            return Response(f'unknown camera {", ".join(unknown)}', status=404)
+        composer = mosaic(hostnames, request.args.get('tile', 320, type=int))
+        if composer is None:
+            return Response('too many mosaics, reuse the camera lists and tile sizes of running ones', status=503)
+        return stream_response(request, composer, tuple(hostnames) or tuple(broadcasters))
+    return stream_response(request, broadcaster)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import click
+import zmq
+import numpy as np
+import multiprocessing
+from threading import Thread, Lock
+from utils import JpegFrame, as_image
+from processors import FrameTagger
+from metrics import REGISTRY
+
+
+def encode_job(seq, frame):
+    if isinstance(frame, JpegFrame):
+        return dict(seq=seq, jpg=True), frame.jpg
+    frame = np.ascontiguousarray(as_image(frame))
+    return dict(seq=seq, shape=frame.shape, dtype=str(frame.dtype)), frame
+
+def decode_job(header, buffer):
+    if header.get('jpg'):
+        return as_image(JpegFrame(buffer))
+    return np.frombuffer(buffer, dtype=header['dtype']).reshape(header['shape'])
+
+def tag_worker(tagging, host, farm_port, decode_qrcodes=False):
+    # one FrameTagger per worker process; jobs are spread round-robin, so no stateful tracking here
+    FrameTagger.timer_logger = None
+    tagger = FrameTagger(tagging, decode_qrcodes=decode_qrcodes)
+    context = zmq.Context()
+    jobs = context.socket(zmq.PULL)
+    jobs.setsockopt(zmq.RCVHWM, 2)
+    jobs.connect(f'tcp://{host}:{farm_port}')
+    results = context.socket(zmq.PUSH)
+    results.connect(f'tcp://{host}:{farm_port + 1}')
+    print(f'tag worker {os.getpid()} connected to {host}:{farm_port}')
+    while True:
+        header, buffer = jobs.recv_multipart(copy=False)
+        header = json.loads(header.bytes)
+        try:
+            tags = tagger.detect_frame_tags(decode_job(header, buffer.buffer))
+            results.send_json(dict(seq=header['seq'], tags=tags, payloads=tagger.payloads))
+        except Exception as e:
+            print('tag worker failed on frame', header['seq'], e)
+            results.send_json(dict(seq=header['seq'], error=str(e)))
+
+class TagFarm():
+    """
+    Fans frames out to tag workers over zmq PUSH/PULL and hands the results back in
+    frame order. Local workers are spawned as processes, remote ones run tag_farm.py
+    and connect to farm_port (jobs) and farm_port + 1 (results). Results wait in a
+    reordering window; a frame whose result is lost is given up on after timeout or
+    once window later results are waiting, so one dead worker cannot stall the stream.
+    zmq buffers many more jobs than its high water marks suggest, so the number of frames
+    in flight is capped explicitly and frames beyond it are dropped instead of queued.
+    """
+
+    def __init__(self, tagging, on_result, workers=0, farm_port=5570, window=16, timeout=10.0, max_in_flight=None, decode_qrcodes=False):
+        self.on_result = on_result
+        self.window = window
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight or (2 * workers if workers else window)
+        self.context = zmq.Context.instance()
+        self.jobs = self.context.socket(zmq.PUSH)
+        self.jobs.setsockopt(zmq.SNDHWM, 2)
+        self.jobs.bind(f'tcp://*:{farm_port}')
+        self.results = self.context.socket(zmq.PULL)
+        self.results.setsockopt(zmq.RCVTIMEO, 500)
+        self.results.bind(f'tcp://*:{farm_port + 1}')
+        self.seq = 0
+        self.next_seq = 1
+        self.pending = {}
+        self.done = {}
+        self._lock = Lock()
+        self.busy = REGISTRY.counter('identific_farm_busy_total', 'frames dropped because every tag worker was busy')
+        self.lost = REGISTRY.counter('identific_farm_lost_total', 'frames whose tagging result never came back')
+        REGISTRY.gauge('identific_queue_depth', 'frames waiting in a queue', fn=lambda: len(self.pending), queue='tag_farm')
+
+        spawn = multiprocessing.get_context('spawn')
+        self.processes = [spawn.Process(target=tag_worker, args=(tagging, '127.0.0.1', farm_port, decode_qrcodes), daemon=True) for _ in range(workers)]
+        for p in self.processes:
+            p.start()
+        self._thread = Thread(target=self._collect, daemon=True)
+        self._thread.start()
+
+    def submit(self, msg, frame):
+        with self._lock:
+            if len(self.pending) >= self.max_in_flight:
+                self.busy.inc()
+                return False
+            seq = self.seq + 1
+            header, buffer = encode_job(seq, frame)
+            try:
+                self.jobs.send_multipart([json.dumps(header).encode(), buffer], flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                self.busy.inc()
+                return False
+            self.seq = seq
+            self.pending[seq] = (msg, frame, time.monotonic())
+            return True
+
+    def _collect(self):
+        while True:
+            try:
+                result = self.results.recv_json()
+                with self._lock:
+                    if result['seq'] >= self.next_seq:
+                        self.done[result['seq']] = result
+            except zmq.Again:
+                pass
+            for item in self._ready():
+                self.on_result(*item)
+
+    def _ready(self):
+        ready = []
+        with self._lock:
+            while self.next_seq <= self.seq:
+                seq = self.next_seq
+                if seq in self.done:
+                    result = self.done.pop(seq)
+                    msg, frame, _ = self.pending.pop(seq)
+                    if 'tags' in result:
+                        ready.append((msg, frame, result['tags'], result.get('payloads', {})))
+                    else:
+                        self.lost.inc()
+                elif len(self.done) > self.window or time.monotonic() - self.pending[seq][2] > self.timeout:
+                    self.pending.pop(seq)
+                    self.lost.inc()
+                else:
+                    break
+                self.next_seq += 1
+        return ready
+
+    def close(self):
+        for p in self.processes:
+            p.terminate()
+
+
+@click.command()
+@click.option('--connect', default='127.0.0.1', help='host running stream-processor --processor tag')
+@click.option('--farm-port', default=5570)
+@click.option('--tagging', default='qrcode,plate,face', help='available taggings: qrcode,plate,face')
+@click.option('--workers', default=os.cpu_count(), help='worker processes to run on this node')
+@click.option('--decode-qrcodes', is_flag=True, default=False, help='also decode the payloads of the qr codes found')
+def run_tag_workers(connect, farm_port, tagging, workers, decode_qrcodes):
+    spawn = multiprocessing.get_context('spawn')
+    processes = [spawn.Process(target=tag_worker, args=(tagging, connect, farm_port, decode_qrcodes)) for _ in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+if __name__ == '__main__':
+    run_tag_workers()
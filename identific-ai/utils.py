@@ -1,6 +1,14 @@
 import cv2
 import json
+import weakref
 import numpy as np
+from threading import Lock
+
+TRANSFORMATIONS = {
+    'Rotate': ('degrees',),
+    'Crop': ('width', 'height', 'xPosition', 'yPosition'),
+    'Resize': (),
+}
 
 def apply_transform(frame, transform):
     """
@@ -24,22 +32,300 @@ def apply_transform(frame, transform):
     }
     """
     if transform:
-        operations = json.loads(transform)
-        for o in operations:
-            if o['transformation'] == 'Rotate':
-                frame = image_rotate(frame, int(o['degrees']))
-            if o['transformation'] == 'Crop':
-                frame = frame[o['yPosition']:o['yPosition']+o['height'], o['xPosition']:+o['xPosition']+o['width']]
-            if o['transformation'] == 'Resize':
-                frame = image_resize(frame, width=o['width'], height=o['height'])
+        if not isinstance(transform, TransformPipeline):
+            transform = TransformPipeline(transform)
+        frame = transform(frame)
     return frame
 
+def compile_transform(transform, buffers=1):
+    if not transform:
+        return None
+    return TransformPipeline(transform, buffers=buffers)
+
+class TransformPipeline():
+    """
+    A --transform spec parsed once and folded into as few affine maps as the operations
+    allow, re-planned only when the input frame shape changes. The spec is split after a
+    crop or rotation that a later rotation would otherwise see past, so every part
+    keeps the black corners of its own input.
+    Frames returned by a warp/resize are written into recycled buffers: a buffer is
+    only reused once release() hands it back, at most `buffers` are kept for reuse
+    and frames never released are left to the garbage collector.
+    """
+
+    def __init__(self, transform, buffers=1):
+        operations = json.loads(transform) if isinstance(transform, str) else transform
+        if isinstance(operations, dict):
+            operations = [operations]
+        self.operations = [o for o in (self.validate(o) for o in operations) if o is not None]
+        self.buffers = max(1, int(buffers))
+        self._plan_key = None
+        self._plan = None
+        self._scratch = {}
+        self._free = []
+        self._issued = weakref.WeakValueDictionary()
+        self._lock = Lock()
+
+    @staticmethod
+    def validate(o):
+        name = o.get('transformation') if isinstance(o, dict) else None
+        if name not in TRANSFORMATIONS:
+            raise ValueError(f'unknown transformation: {o!r}')
+        missing = [k for k in TRANSFORMATIONS[name] if k not in o]
+        if missing:
+            raise ValueError(f'{name} transformation is missing {", ".join(missing)}')
+        if name == 'Rotate':
+            degrees = float(o['degrees'])
+            return (name, degrees) if degrees % 360 else None
+        if name == 'Crop':
+            x, y, w, h = (int(o[k]) for k in ('xPosition', 'yPosition', 'width', 'height'))
+            if min(x, y, w, h) < 0:
+                raise ValueError(f'Crop values must be positive: {o!r}')
+            return (name, x, y, w, h)
+        width, height = o.get('width'), o.get('height')
+        if width is None and height is None:
+            return None
+        return (name, None if width is None else int(width), None if height is None else int(height))
+
+    def __call__(self, frame):
+        key = (frame.shape, frame.dtype)
+        if key != self._plan_key:
+            self._plan = self.plan(frame.shape)
+            self._plan_key = key
+            self._scratch = {}
+            with self._lock:
+                self._free = []
+        for i, (mode, args) in enumerate(self._plan):
+            if mode == 'identity':
+                continue
+            if mode == 'slice':
+                frame = frame[args]
+                continue
+            # only the last step writes to a buffer that leaves the pipeline
+            last = i == len(self._plan) - 1
+            if mode == 'resize':
+                region, dim, inter = args
+                out = self._output_buffer(frame) if last else self._scratch_buffer(i, frame, dim)
+                frame = cv2.resize(frame[region], dim, dst=out, interpolation=inter)
+            elif mode == 'warp':
+                matrix, dim = args
+                out = self._output_buffer(frame) if last else self._scratch_buffer(i, frame, dim)
+                frame = cv2.warpAffine(frame, matrix, dim, dst=out, flags=cv2.INTER_LINEAR)
+            else:
+                matrix, native, dim = args
+                warped = cv2.warpAffine(frame, matrix, native, dst=self._scratch_buffer((i, 'native'), frame, native), flags=cv2.INTER_LINEAR)
+                out = self._output_buffer(frame) if last else self._scratch_buffer(i, frame, dim)
+                frame = cv2.resize(warped, dim, dst=out, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def _scratch_buffer(self, key, frame, dim):
+        # intermediate results, consumed within the same call
+        w, h = dim
+        if key not in self._scratch:
+            self._scratch[key] = np.empty((h, w) + frame.shape[2:], dtype=frame.dtype)
+        return self._scratch[key]
+
+    def _output_buffer(self, frame):
+        w, h = self.output_size
+        with self._lock:
+            out = self._free.pop() if self._free else np.empty((h, w) + frame.shape[2:], dtype=frame.dtype)
+            self._issued[id(out)] = out
+        return out
+
+    def release(self, frame):
+        # give back a frame returned by this pipeline once nothing reads it anymore
+        with self._lock:
+            if isinstance(frame, np.ndarray) and self._issued.get(id(frame)) is frame:
+                del self._issued[id(frame)]
+                # a frame from before the input shape changed is not reused
+                if len(self._free) < self.buffers and frame.shape[1::-1] == self.output_size:
+                    self._free.append(frame)
+
+    def plan(self, shape):
+        # one step per part of the spec, each planned for the output shape of the previous
+        parts = [[]]
+        for i, o in enumerate(self.operations):
+            parts[-1].append(o)
+            if o[0] in ('Crop', 'Rotate') and any(later[0] == 'Rotate' for later in self.operations[i + 1:]):
+                parts.append([])
+        steps = []
+        for part in parts:
+            step, size = self.plan_part(part, shape)
+            steps.append(step)
+            shape = (size[1], size[0]) + tuple(shape[2:])
+        self.output_size = size
+        return steps
+
+    def plan_part(self, operations, shape):
+        # compose the operations into one 3x3 matrix mapping source to output pixels
+        h, w = shape[:2]
+        m = np.eye(3)
+        for o in operations:
+            a = np.eye(3)
+            if o[0] == 'Rotate':
+                a[:2] = cv2.getRotationMatrix2D((w / 2, h / 2), o[1], 1.0)
+            elif o[0] == 'Crop':
+                _, x, y, cw, ch = o
+                x0, y0 = min(x, w), min(y, h)
+                a[0, 2], a[1, 2] = -x0, -y0
+                w, h = min(x0 + cw, w) - x0, min(y0 + ch, h) - y0
+            else:
+                _, rw, rh = o
+                if rw is None:
+                    dim = (int(w * rh / float(h)), rh)
+                else:
+                    dim = (rw, int(h * rw / float(w)))
+                a[0, 0], a[1, 1] = dim[0] / float(w), dim[1] / float(h)
+                w, h = dim
+            m = a @ m
+
+        if np.allclose(m, np.eye(3)) and (w, h) == tuple(shape[1::-1]):
+            return ('identity', None), (w, h)
+        if m[0, 1] == 0 and m[1, 0] == 0 and m[0, 0] > 0 and m[1, 1] > 0:
+            # axis aligned: a slice of the source, resized if scaled
+            sx, sy = m[0, 0], m[1, 1]
+            x0, y0 = -m[0, 2] / sx, -m[1, 2] / sy
+            sw, sh = w / sx, h / sy
+            corners = np.array([x0, y0, sw, sh])
+            if np.allclose(corners, np.round(corners), atol=1e-6) and x0 >= 0 and y0 >= 0 \
+                    and x0 + sw <= shape[1] + 1e-6 and y0 + sh <= shape[0] + 1e-6:
+                x0, y0, sw, sh = (int(round(v)) for v in corners)
+                region = (slice(y0, y0 + sh), slice(x0, x0 + sw))
+                if (sw, sh) == (w, h):
+                    return ('slice', region), (w, h)
+                if w == 0 or h == 0:
+                    return ('slice', (slice(0, h), slice(0, w))), (w, h)
+                return ('resize', (region, (w, h), cv2.INTER_AREA)), (w, h)
+        sx, sy = np.hypot(m[0, 0], m[0, 1]), np.hypot(m[1, 0], m[1, 1])
+        if w and h and min(sx, sy) < 0.75:
+            # warping straight to a much smaller size aliases: warp at the source scale, then shrink
+            native = (max(1, int(round(w / sx))), max(1, int(round(h / sy))))
+            m = np.diag([native[0] / w, native[1] / h, 1.0]) @ m
+            return ('warp_resize', (m[:2].copy(), native, (w, h))), (w, h)
+        return ('warp', (m[:2].copy(), (w, h))), (w, h)
+
 def image_rotate(image, angle):
     image_center = tuple(np.array(image.shape[1::-1]) / 2)
     rot_mat = cv2.getRotationMatrix2D(image_center, angle, 1.0)
     result = cv2.warpAffine(image, rot_mat, image.shape[1::-1], flags=cv2.INTER_LINEAR)
     return result
 
+class JpegFrame():
+    """
+    A frame received as JPEG bytes. Pixels are decoded on first access to .image only,
+    so consumers that just forward the bytes never pay for a decode.
+    """
+
+    def __init__(self, jpg):
+        self.jpg = jpg
+        self._image = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = cv2.imdecode(np.frombuffer(self.jpg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return self._image
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+class RoiFrame():
+    """
+    The tagged regions of a frame at native resolution, each padded by a margin, plus a
+    downscaled thumbnail of the whole scene. .image rebuilds a full size frame lazily:
+    the thumbnail scaled back up with the crops pasted over it. parts holds the thumbnail
+    then one crop per rect, as arrays or, once encoded, as JPEG bytes.
+    """
+
+    def __init__(self, shape, rects, parts, jpg=False):
+        self.shape = tuple(shape)
+        self.rects = [tuple(r) for r in rects]
+        self.parts = parts
+        self.jpg = jpg
+        self._decoded = None
+        self._image = None
+
+    @classmethod
+    def from_frame(cls, frame, tags, padding=16, thumbnail_width=320):
+        h, w = frame.shape[:2]
+        rects = []
+        for found in tags.values():
+            for points in found:
+                x, y, rw, rh = cv2.boundingRect(np.asarray(points, dtype=np.int32))
+                x0, y0 = max(0, x - padding), max(0, y - padding)
+                rects.append((x0, y0, min(w, x + rw + padding) - x0, min(h, y + rh + padding) - y0))
+        # overlapping crops are sent once, as their union
+        rects = [r for r in merge_rects(rects) if r[2] > 0 and r[3] > 0]
+        thumbnail = image_resize(frame, width=min(w, thumbnail_width))
+        return cls(frame.shape, rects, [thumbnail] + [frame[y:y + rh, x:x + rw] for x, y, rw, rh in rects])
+
+    def encode(self, quality=90):
+        if self.jpg:
+            return self
+        return RoiFrame(self.shape, self.rects, [cv2.imencode('.jpg', part, [cv2.IMWRITE_JPEG_QUALITY, quality])[1] for part in self.parts], jpg=True)
+
+    def pack(self):
+        # a layout for the message header and every part back to back in one buffer
+        parts = [np.frombuffer(part, dtype=np.uint8) if self.jpg else np.ascontiguousarray(part).reshape(-1) for part in self.parts]
+        layout = dict(shape=list(self.shape), rects=[list(r) for r in self.rects], jpg=self.jpg, nbytes=[p.nbytes for p in parts])
+        if not self.jpg:
+            layout['shapes'] = [list(part.shape) for part in self.parts]
+            layout['dtype'] = str(self.parts[0].dtype)
+        return layout, np.concatenate(parts)
+
+    @classmethod
+    def unpack(cls, layout, buffer):
+        # the parts are views into buffer
+        buffer = np.frombuffer(buffer, dtype=np.uint8)
+        offsets = np.cumsum([0] + layout['nbytes'])
+        parts = [buffer[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        if not layout['jpg']:
+            parts = [part.view(layout['dtype']).reshape(shape) for part, shape in zip(parts, layout['shapes'])]
+        return cls(layout['shape'], layout['rects'], parts, jpg=layout['jpg'])
+
+    def decoded(self):
+        if self._decoded is None:
+            self._decoded = [cv2.imdecode(np.frombuffer(part, dtype=np.uint8), cv2.IMREAD_UNCHANGED) for part in self.parts] if self.jpg else self.parts
+        return self._decoded
+
+    @property
+    def thumbnail(self):
+        return self.decoded()[0]
+
+    @property
+    def crops(self):
+        return list(zip(self.rects, self.decoded()[1:]))
+
+    @property
+    def image(self):
+        if self._image is None:
+            h, w = self.shape[:2]
+            image = cv2.resize(self.thumbnail, (w, h), interpolation=cv2.INTER_LINEAR)
+            for (x, y, rw, rh), crop in self.crops:
+                image[y:y + rh, x:x + rw] = crop
+            self._image = image
+        return self._image
+
+    def copy(self):
+        return RoiFrame(self.shape, self.rects, [bytes(part) if self.jpg else part.copy() for part in self.parts], jpg=self.jpg)
+
+def as_image(frame):
+    if isinstance(frame, (JpegFrame, RoiFrame)):
+        return frame.image
+    return frame
+
+def retain(frame):
+    # detach a frame from a shared or recycled buffer before holding on to it
+    if isinstance(frame, JpegFrame):
+        return JpegFrame(bytes(frame.jpg))
+    return frame.copy()
+
+def as_jpeg(frame, quality=95):
+    if isinstance(frame, JpegFrame):
+        return bytes(frame.jpg)
+    return cv2.imencode('.jpg', as_image(frame), [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
 def rect_as_points(rect):
     x, y, w, h = rect
     p1 = [x, y]
@@ -48,6 +334,34 @@ def rect_as_points(rect):
     p4 = [x, y+h]
     return [p1, p2, p3, p4]
 
+def rects_intersect(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+def rect_iou(a, b):
+    w = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    h = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / float(a[2] * a[3] + b[2] * b[3] - inter)
+
+def merge_rects(rects):
+    rects = [list(r) for r in rects]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                if rects_intersect(rects[i], rects[j]):
+                    a, b = rects[i], rects.pop(j)
+                    x, y = min(a[0], b[0]), min(a[1], b[1])
+                    rects[i] = [x, y, max(a[0] + a[2], b[0] + b[2]) - x, max(a[1] + a[3], b[1] + b[3]) - y]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(r) for r in rects]
+
 def image_resize(image, width = None, height = None, inter = cv2.INTER_AREA):
     dim = None
     (h, w) = image.shape[:2]